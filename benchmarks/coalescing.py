@@ -0,0 +1,106 @@
+"""
+Measures the frames sent to one websocket of a busy room, with and without
+coalescing (CHATTER_COALESCING):
+
+* frames: websocket frames sent for all the events
+* bytes: total size of the frames
+* latency: time from the event reaching the consumer to its frame being sent
+* CPU: process time spent encoding and sending
+
+    python benchmarks/coalescing.py [events per second] [seconds]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatter.settings')
+
+import django
+
+django.setup()
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+
+from django_chatter.coalescing import CoalescingMixin
+
+
+class BenchmarkConsumer(CoalescingMixin, AsyncJsonWebsocketConsumer):
+    """Records the frames instead of sending them to a client"""
+
+    def __init__(self):
+        super().__init__({'type': 'websocket'})
+        self.frames = []
+
+    async def base_send(self, message):
+        self.frames.append((time.perf_counter(), message['text']))
+
+
+def make_event(index):
+    return {
+        'type': 'send_to_websocket',
+        'message_type': 'text',
+        'id': index,
+        'seq': index,
+        'message': f"Message number {index} of the benchmark",
+        'date_created': '2019-05-25T03:15:00.000000+00:00',
+        'sender': {'id': 1, 'name': 'user0'},
+        'room_id': '8b0d5bd6-d6bd-4d3e-9f7b-6f7f6c0c3f8e',
+    }
+
+
+async def run(rate, seconds):
+    consumer = BenchmarkConsumer()
+    received = []
+    interval = 1 / rate
+    started = time.perf_counter()
+    cpu = time.process_time()
+    for index in range(int(rate * seconds)):
+        # events arrive at a steady rate
+        delay = started + index * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        received.append(time.perf_counter())
+        await consumer.send_event(make_event(index))
+    await consumer.flush_events()
+    cpu = time.process_time() - cpu
+
+    latencies = []
+    index = 0
+    for sent, text in consumer.frames:
+        count = text.count('"type"')
+        latencies += [sent - at for at in received[index:index + count]]
+        index += count
+    return {
+        'frames': len(consumer.frames),
+        'bytes': sum(len(text) for sent, text in consumer.frames),
+        'p50': statistics.median(latencies) * 1000,
+        'p99': sorted(latencies)[int(len(latencies) * 0.99)] * 1000,
+        'cpu': cpu * 1000,
+    }
+
+
+def main():
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    print(f"{rate} events/s for {seconds}s")
+    print(f"{'mode':<22}{'frames':>8}{'bytes':>10}{'p50 ms':>9}{'p99 ms':>9}{'CPU ms':>9}")
+    for config in ({'enabled': False},
+                   {'enabled': True, 'window': 0.010, 'max_events': 50},
+                   {'enabled': True, 'window': 0.025, 'max_events': 50},
+                   {'enabled': True, 'window': 0.025, 'max_events': 200}):
+        settings.CHATTER_COALESCING = config
+        result = asyncio.get_event_loop().run_until_complete(run(rate, seconds))
+        if config['enabled']:
+            mode = f"{config['window'] * 1000:.0f}ms/{config['max_events']} events"
+        else:
+            mode = 'off'
+        print(f"{mode:<22}{result['frames']:>8}{result['bytes']:>10}"
+              f"{result['p50']:>9.2f}{result['p99']:>9.2f}{result['cpu']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
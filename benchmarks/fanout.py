@@ -0,0 +1,99 @@
+"""
+Compares the cost of alerting every member of a room about a new message:
+
+* sequential: one awaited group_send per member, one after another (previous code)
+* user: one group_send per member, all in flight at once (CHATTER_ALERT_FANOUT='user')
+* room: a single group_send to the room alert topic (CHATTER_ALERT_FANOUT='room')
+
+    python benchmarks/fanout.py
+
+Layers: InMemoryChannelLayer, and a stand-in for Redis that adds a network round
+trip to every group operation. Set REDIS_URL=redis://host:port to also run
+against a real channels_redis layer.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatter.settings')
+
+import django
+
+django.setup()
+
+from channels.layers import InMemoryChannelLayer
+
+from django_chatter.fanout import (
+    get_room_alerts_group_name,
+    get_user_group_name,
+    send_to_room_alerts,
+    send_to_users,
+)
+
+ROUND_TRIP = 0.0005
+MESSAGES = 20
+ROOM_PK = 'benchmark'
+
+
+class RoundTripChannelLayer(InMemoryChannelLayer):
+    """InMemoryChannelLayer paying a network round trip on every group send"""
+
+    async def group_send(self, group, message):
+        await asyncio.sleep(ROUND_TRIP)
+        await super().group_send(group, message)
+
+
+def make_layer(name):
+    if name == 'redis':
+        from channels_redis.core import RedisChannelLayer
+        return RedisChannelLayer(hosts=[os.environ['REDIS_URL']], capacity=100000)
+    if name == 'round trip':
+        return RoundTripChannelLayer(capacity=100000)
+    return InMemoryChannelLayer(capacity=100000)
+
+
+async def send_sequentially(channel_layer, users_pks, event):
+    for user_pk in users_pks:
+        await channel_layer.group_send(get_user_group_name(user_pk), event)
+
+
+async def run(layer_name, members):
+    channel_layer = make_layer(layer_name)
+    users_pks = list(range(members))
+    for user_pk in users_pks:
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(get_user_group_name(user_pk), channel)
+        await channel_layer.group_add(get_room_alerts_group_name(ROOM_PK), channel)
+    event = {'type': 'send_to_websocket', 'message_type': 'text', 'message': 'Hello!',
+             'sender': {'id': 0, 'name': 'user0'}, 'room_id': ROOM_PK}
+    strategies = [
+        ('sequential', lambda: send_sequentially(channel_layer, users_pks, event)),
+        ('user', lambda: send_to_users(channel_layer, users_pks, event)),
+        ('room', lambda: send_to_room_alerts(channel_layer, ROOM_PK, event)),
+    ]
+    results = []
+    for name, fanout in strategies:
+        start = time.perf_counter()
+        for i in range(MESSAGES):
+            await fanout()
+        results.append((name, (time.perf_counter() - start) / MESSAGES * 1000))
+    if hasattr(channel_layer, 'flush'):
+        await channel_layer.flush()
+    return results
+
+
+def main():
+    layers = ['in memory', 'round trip']
+    if os.environ.get('REDIS_URL'):
+        layers.append('redis')
+    for layer_name in layers:
+        for members in (10, 100, 500):
+            results = asyncio.get_event_loop().run_until_complete(run(layer_name, members))
+            print(f"{layer_name:10} {members:4} members: " + "  ".join(
+                f"{name} {ms:8.3f} ms/message" for name, ms in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Messages sanitized per second:
+
+* bleach.clean: a new Cleaner for each message, as ChatConsumer used to do
+* Cleaner: the Cleaner built once and reused (django_chatter.sanitizers.get_cleaner)
+* sanitize: the whole pipeline (CHATTER_SANITIZERS)
+* sanitize_async: the pipeline run in the thread pool, as ChatConsumer does,
+  with `concurrency` messages at a time
+
+    python benchmarks/sanitize.py [messages] [concurrency]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatter.settings')
+
+import django
+
+django.setup()
+
+import bleach
+
+from django_chatter.sanitizers import get_cleaner, sanitize, sanitize_async
+
+TEXTS = [
+    "Hello, are we still meeting at 3pm?",
+    "Check <a href=\"https://example.com\" onclick=\"evil()\">this</a> out",
+    "<script>alert('x');</script> & some <b>bold</b> text " * 4,
+]
+
+
+def measure(function, count):
+    started = time.perf_counter()
+    for index in range(count):
+        function(TEXTS[index % len(TEXTS)])
+    return count / (time.perf_counter() - started)
+
+
+async def measure_async(count, concurrency):
+    started = time.perf_counter()
+    for start in range(0, count, concurrency):
+        await asyncio.gather(*[sanitize_async(TEXTS[index % len(TEXTS)], False)
+                               for index in range(start, min(start + concurrency, count))])
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    cleaner = get_cleaner()
+    print(f"{count} messages")
+    print(f"{'mode':<20}{'messages/s':>12}")
+    for mode, function in (('bleach.clean', bleach.clean),
+                           ('Cleaner', cleaner.clean),
+                           ('sanitize', lambda text: sanitize(text, False))):
+        print(f"{mode:<20}{measure(function, count):>12.0f}")
+    rate = asyncio.get_event_loop().run_until_complete(measure_async(count, concurrency))
+    print(f"{'sanitize_async':<20}{rate:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
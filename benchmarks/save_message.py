@@ -0,0 +1,68 @@
+"""
+Counts the SQL statements (database round trips) and the time needed to store
+one chat message, comparing the previous save_message with Room.add_message.
+
+    python benchmarks/save_message.py [messages]
+
+It runs against a throw-away test database created from DJANGO_SETTINGS_MODULE
+(chatter.settings by default).
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatter.settings')
+
+import django
+
+django.setup()
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from django_chatter.models import Room, Message
+
+
+def legacy_save_message(room, sender, text):
+    """save_message before the single transaction write path"""
+    new_message = Message(room=room, sender=sender, text=text)
+    new_message.save()
+    new_message.recipients.add(sender)
+    new_message.save()
+    room.date_modified = new_message.date_modified
+    room.save()
+    return new_message
+
+
+def single_transaction_save_message(room, sender, text):
+    return room.add_message(sender, text)
+
+
+def run(save, room, sender, messages):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for i in range(messages):
+            save(room, sender, f"message {i}")
+        elapsed = time.perf_counter() - start
+    return len(queries) / messages, elapsed / messages * 1000
+
+
+def main(messages=200):
+    user_model = get_user_model()
+    sender = user_model.objects.create(username="benchmark-sender")
+    others = [user_model.objects.create(username=f"benchmark-{i}") for i in range(4)]
+    for save in (legacy_save_message, single_transaction_save_message):
+        room = Room.objects.create()
+        room.members.add(sender, *others)
+        statements, ms = run(save, room, sender, messages)
+        print(f"{save.__name__:35} {statements:5.1f} statements/message {ms:8.3f} ms/message")
+
+
+if __name__ == '__main__':
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        main(*[int(arg) for arg in sys.argv[1:2]])
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
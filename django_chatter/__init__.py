@@ -1 +1,3 @@
 name = "django_chatter"
+
+default_app_config = 'django_chatter.apps.ChatterConfig'
@@ -5,3 +5,4 @@ from .models import *
 # Register your models here.
 admin.site.register(Room)
 admin.site.register(Message)
+admin.site.register(RoomMembership)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChatterConfig(AppConfig):
     name = 'django_chatter'
     verbose_name = "Django Chatter"
+
+    def ready(self):
+        from django_chatter import signals  # noqa
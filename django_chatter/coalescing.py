@@ -0,0 +1,63 @@
+import asyncio
+
+from django.conf import settings
+
+
+def get_coalescing_config():
+    """Coalescing of the events sent to websockets (disabled by default):
+    CHATTER_COALESCING = {'enabled': True, 'window': 0.015, 'max_events': 50}
+    Events are sent together, as a single JSON array frame, `window` seconds
+    after the first one or as soon as `max_events` are waiting.
+    """
+    config = dict(getattr(settings, "CHATTER_COALESCING", {}))
+    config.setdefault('enabled', False)
+    config.setdefault('window', 0.015)
+    config.setdefault('max_events', 50)
+    return config
+
+
+class CoalescingMixin:
+    """Mixin for AsyncJsonWebsocketConsumer: `send_event` buffers the events of
+    the channel layer and sends them in array frames. Frames sent directly with
+    `send_json` go after the buffered events, so the order is kept.
+    """
+    pending_events = None
+    flush_task = None
+
+    async def send_event(self, event):
+        config = get_coalescing_config()
+        if not config['enabled']:
+            await self.send_json(event)
+            return
+        if self.pending_events is None:
+            self.pending_events = []
+        self.pending_events.append(event)
+        if len(self.pending_events) >= config['max_events']:
+            await self.flush_events()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later(config['window']))
+
+    async def flush_later(self, window):
+        await asyncio.sleep(window)
+        self.flush_task = None
+        await self.flush_events()
+
+    def cancel_flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+    async def flush_events(self):
+        self.cancel_flush()
+        events, self.pending_events = self.pending_events, None
+        if events:
+            await super().send_json(events)
+
+    async def send_json(self, content, close=False):
+        if self.pending_events:
+            await self.flush_events()
+        await super().send_json(content, close=close)
+
+    async def websocket_disconnect(self, message):
+        self.cancel_flush()
+        await super().websocket_disconnect(message)
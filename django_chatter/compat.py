@@ -1,4 +1,13 @@
+import asyncio
+from functools import partial
+
 try:
     from django.urls import re_path as path
 except ImportError:  # django==1.11.xx
     from django.conf.urls import url as path
+
+
+def run_in_executor(func, *args, **kwargs):
+    """Runs a blocking function that doesn't touch the database in the default
+    thread pool of the event loop (asgiref<3.3 has no sync_to_async(thread_sensitive=False))"""
+    return asyncio.get_event_loop().run_in_executor(None, partial(func, *args, **kwargs))
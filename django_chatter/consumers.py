@@ -1,54 +1,271 @@
-import bleach
+import asyncio
+import time
+from urllib.parse import parse_qs
+
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
 from uuid import UUID
 
-from django_chatter.models import Room, Message
+from django_chatter.cache import TTLCache
+from django_chatter.coalescing import CoalescingMixin
+from django_chatter.compat import run_in_executor
+from django_chatter.fanout import (
+    ROOM_FANOUT,
+    get_alert_fanout,
+    get_chat_group_name,
+    get_room_alerts_group_name,
+    get_user_group_name,
+    is_large_room,
+    send_room_activity,
+    send_to_room_alerts,
+    send_to_users,
+)
+from django_chatter.models import CLIENT_ID_MAX_LENGTH, Room, RoomMembership
+from django_chatter.persistence import (
+    claim_client_id,
+    get_write_behind_config,
+    get_write_buffer,
+)
+from django_chatter.presence import PresenceMixin, get_presence_config
+from django_chatter.ratelimit import throttle_message
+from django_chatter.recent import get_history, remember_message
+from django_chatter.sanitizers import sanitize_async
+from django_chatter.utils import tenant_context
+from django_chatter.wire import WireFormatMixin
 
 
 @database_sync_to_async
 def get_room(room_id, multitenant=False, schema_name=None):
-    if multitenant:
-        if not schema_name:
-            raise AttributeError("Multitenancy support error: \
-                scope does not have multitenancy details added. \
-                did you forget to add ChatterMTMiddlewareStack to your routing?")
-        else:
-            from django_tenants.utils import schema_context
-            with schema_context(schema_name):
-                return Room.objects.get(pk=room_id)
-    else:
+    with tenant_context(multitenant, schema_name):
         return Room.objects.get(pk=room_id)
 
 
 @database_sync_to_async
-def save_message(room, sender, text, multitenant=False, schema_name=None):
-    if multitenant:
-        if not schema_name:
-            raise AttributeError("Multitenancy support error: \
-                scope does not have multitenancy details added. \
-                did you forget to add ChatterMTMiddlewareStack to your routing?")
+def get_members_pks(room, multitenant=False, schema_name=None):
+    with tenant_context(multitenant, schema_name):
+        return set(room.get_members_all(pks=True))
+
+
+@database_sync_to_async
+def get_rooms_pks(user, multitenant=False, schema_name=None):
+    with tenant_context(multitenant, schema_name):
+        return [str(room_pk) for room_pk in
+                RoomMembership.objects.filter(user=user).values_list('room', flat=True)]
+
+
+def get_text_safe(text, sanitized):
+    """The sanitized text as stored in Message.text_safe"""
+    return None if sanitized == text else sanitized
+
+
+@database_sync_to_async
+def save_message(room, sender, text, multitenant=False, schema_name=None, client_id=None,
+                 text_safe=None):
+    """Stores the message and returns it, and whether it's new: the message the
+    sender already sent with the same `client_id` is returned instead"""
+    with tenant_context(multitenant, schema_name):
+        try:
+            message = room.add_message(sender, text, client_id=client_id,
+                                       text_safe=text_safe)
+        except IntegrityError:
+            if client_id is None:
+                raise
+            return room.message_set.get(sender=sender, client_id=client_id), False
+        remember_message(room, message)
+        return message, True
+
+
+def get_client_id(data):
+    """The id given by the client to the message, if valid"""
+    client_id = data.get('client_id')
+    if isinstance(client_id, str) and 0 < len(client_id) <= CLIENT_ID_MAX_LENGTH:
+        return client_id
+    return None
+
+
+@database_sync_to_async
+def get_history_messages(room, count, last_id=None, since_seq=None,
+                         multitenant=False, schema_name=None):
+    with tenant_context(multitenant, schema_name):
+        return get_history(room, count, last_id=last_id, since_seq=since_seq)
+
+
+def get_connect_history_size():
+    """Number of messages sent by ChatConsumer when a websocket connects,
+    the latest ones or those after the `last_id` of the query string.
+    0 (default) sends none."""
+    return getattr(settings, "CHATTER_CONNECT_HISTORY", 0)
+
+
+def get_resume_limit():
+    """Most messages sent by ChatConsumer to a websocket resuming after the
+    `since_seq` of the query string (500 by default)"""
+    return getattr(settings, "CHATTER_RESUME_LIMIT", 500)
+
+
+def get_message_event(message, room_id):
+    """The message (a Message or RecentMessage) as sent to the websocket"""
+    return {
+        'message_type': 'text',
+        'id': message.pk,
+        'seq': message.seq,
+        'message': message.safe_text,
+        'date_created': message.date_created.isoformat(),
+        'sender': {
+            'id': message.sender.pk,
+            'name': str(message.sender)
+        },
+        'room_id': room_id,
+    }
+
+
+class MessagesMixin:
+    """Sends the history of a room and stores and sends the messages of the user
+    to a room, for ChatConsumer and MultiplexConsumer"""
+    # acks of the messages sent with a client id, to answer retries
+    sent_messages = None
+
+    async def send_history(self, room, since_seq=None, last_id=None):
+        """Sends the messages the client has not seen in a single frame, oldest first.
+        When newer messages were left out (`resume`), the client resumes after the
+        last one received."""
+        if since_seq is not None:
+            size = get_resume_limit()
+        else:
+            size = get_connect_history_size()
+        if not size:
+            return
+        messages, more = await get_history_messages(room,
+                                                    size,
+                                                    last_id,
+                                                    since_seq,
+                                                    self.multitenant,
+                                                    self.schema_name)
+        room_id = str(room.pk)
+        resuming = since_seq is not None or last_id is not None
+        await self.send_json({
+            'type': 'history',
+            'room_id': room_id,
+            'messages': [get_message_event(message, room_id) for message in messages],
+            # older messages left out, fetched when scrolling up
+            'more': more and not resuming,
+            # newer messages left out
+            'resume': more and resuming,
+        })
+
+    async def send_message(self, room, members_pks, data):
+        """Stores the 'text' message and sends it to the room and the alerts
+        of its members"""
+        client_id = get_client_id(data)
+        if client_id is not None:
+            ack = self.sent_messages.get(client_id)
+            if ack is not None:
+                # sent again (e.g. the ack was lost): already stored and sent
+                await self.send_json(dict(ack, duplicate=True))
+                return
+        # backpressure: the client sends the message again later
+        throttled = await throttle_message(self.user.pk, room.pk, self.schema_name)
+        if throttled is not None:
+            limit, retry_after = throttled
+            await self.send_json({
+                'type': 'throttled',
+                'client_id': client_id,
+                'room_id': str(room.pk),
+                'limit': limit,
+                'retry_after': round(retry_after, 3),
+            })
+            return
+        message = data['message']
+        html = data.get('html', True)
+
+        # sanitized once, in a thread, and stored alongside the text:
+        # the sanitized text is what is sent and rendered
+        if get_write_behind_config()['enabled']:
+            # broadcast now, store later: the id isn't known yet
+            message_id = message_seq = None
+            created = timezone.now()
+            first_created = None
+            if client_id is not None:
+                # sent again, maybe through another connection or worker
+                first_created = await run_in_executor(claim_client_id,
+                                                      self.schema_name,
+                                                      room.pk,
+                                                      self.user.pk,
+                                                      client_id,
+                                                      created)
+            new = first_created is None
+            if new:
+                sanitized = await sanitize_async(message, html)
+                get_write_buffer().add(room,
+                                       self.user,
+                                       message,
+                                       self.schema_name if self.multitenant else None,
+                                       client_id,
+                                       get_text_safe(message, sanitized))
+                message = sanitized
+            else:
+                created = first_created
+        else:
+            sanitized = await sanitize_async(message, html)
+            stored, new = await save_message(room,
+                                             self.user,
+                                             message,
+                                             self.multitenant,
+                                             self.schema_name,
+                                             client_id,
+                                             get_text_safe(message, sanitized))
+            message_id = stored.pk
+            message_seq = stored.seq
+            message = stored.safe_text
+            created = stored.date_created
+        created = created.isoformat()
+        if client_id is not None:
+            ack = {
+                'type': 'ack',
+                'client_id': client_id,
+                'id': message_id,
+                'seq': message_seq,
+                'date_created': created,
+            }
+            self.sent_messages.set(client_id, ack)
+            await self.send_json(dict(ack, duplicate=not new))
+        if not new:
+            return
+        event = {
+            'type': 'send_to_websocket',
+            'message_type': 'text',
+            'id': message_id,
+            'seq': message_seq,
+            'message': message,
+            'date_created': created,
+            'sender': {
+                'id': self.user.pk,
+                'name': str(self.user)
+            },
+            'room_id': str(room.pk),
+        }
+        await self.channel_layer.group_send(get_chat_group_name(room.pk), event)
+
+        if is_large_room(members_pks):
+            # the members without the room open don't get each message
+            await send_room_activity(self.channel_layer,
+                                     room.pk,
+                                     members_pks - {self.user.pk},
+                                     event,
+                                     self.schema_name)
+        elif get_alert_fanout() == ROOM_FANOUT:
+            await send_to_room_alerts(self.channel_layer, room.pk, event)
         else:
-            from django_tenants.utils import schema_context
-            with schema_context(schema_name):
-                new_message = Message(room=room, sender=sender, text=text)
-                new_message.save()
-                new_message.recipients.add(sender)
-                new_message.save()
-                room.date_modified = new_message.date_modified
-                room.save()
-                return new_message.date_created
-    else:
-        new_message = Message(room=room, sender=sender, text=text)
-        new_message.save()
-        new_message.recipients.add(sender)
-        new_message.save()
-        room.date_modified = new_message.date_modified
-        room.save()
-        return new_message.date_created
-
-
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+            await send_to_users(self.channel_layer,
+                                members_pks - {self.user.pk},
+                                event)
+
+
+class ChatConsumer(CoalescingMixin, PresenceMixin, MessagesMixin, WireFormatMixin,
+                   AsyncJsonWebsocketConsumer):
     """
         WebSocket methods below
     """
@@ -57,11 +274,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     multitenant = None
     room_group_name = None
     room = None
+    members_pks = None
 
     async def connect(self):
         self.user = self.scope['user']
         self.schema_name = self.scope.get('schema_name', None)
         self.multitenant = self.scope.get('multitenant', False)
+        self.sent_messages = TTLCache(maxsize=256, ttl=3600)
 
         for param in self.scope['path'].split('/'):
             try:
@@ -72,35 +291,35 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         else:
             raise Exception("missing 'uuid'")
 
-        # Check if the user connecting to the room's websocket belongs in the room
+        # Check if the user connecting to the room's websocket belongs in the room.
+        # The members are kept for the whole connection and updated by
+        # `membership_changed` events, so messages don't query them again.
+        self.room = await get_room(room_id, self.multitenant, self.schema_name)
+        self.members_pks = await get_members_pks(self.room, self.multitenant, self.schema_name)
+        if self.user.pk in self.members_pks:
+            self.room_group_name = get_chat_group_name(self.room.pk)
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
+            await self.accept()
+            # messages sent to the group meanwhile wait for connect to return
+            await self.send_history(self.room,
+                                    self.get_query_int('since_seq'),
+                                    self.get_query_int('last_id'))
+            await self.join_presence()
+        else:
+            await self.disconnect(403)
+
+    def get_query_int(self, name):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
         try:
-            self.room = await get_room(room_id, self.multitenant, self.schema_name)
-            if self.multitenant:
-                from django_tenants.utils import schema_context
-                with schema_context(self.schema_name):
-                    if self.room.is_member(self.user):
-                        self.room_group_name = f'chat_{self.room.pk}'
-                        await self.channel_layer.group_add(
-                            self.room_group_name,
-                            self.channel_name
-                        )
-                        await self.accept()
-                    else:
-                        await self.disconnect(403)
-            else:
-                if self.room.is_member(self.user):
-                    self.room_group_name = f'chat_{self.room.pk}'
-                    await self.channel_layer.group_add(
-                        self.room_group_name,
-                        self.channel_name
-                    )
-                    await self.accept()
-                else:
-                    await self.disconnect(403)
-        except Exception as ex:
-            raise ex
+            return int(query[name][0])
+        except (KeyError, ValueError):
+            return None
 
     async def disconnect(self, close_code):
+        await self.leave_presence()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -116,70 +335,54 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         message_type = data['message_type']
         if message_type == "text":
-            message = data['message']
-            room_id = data['room_id']
-            html = data.get('html', True)
-
-            # Clean code off message if message contains code
-            if not html:
-                message = bleach.clean(message)
-
-            created = await save_message(self.room,
-                                         self.user,
-                                         message,
-                                         self.multitenant,
-                                         self.schema_name)
-            created = created.isoformat()
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'send_to_websocket',
-                    'message_type': 'text',
-                    'message': message,
-                    'date_created': created,
-                    'sender': {
-                        'id': self.user.pk,
-                        'name': str(self.user)
-                    },
-                    'room_id': room_id,
-                }
-            )
+            await self.send_message(self.room, self.members_pks, data)
+        elif message_type == "typing":
+            # never stored, debounced and sent to the room only
+            await self.receive_typing(data)
 
-            for user_pk in self.room.get_members_all(excluding={'pk': self.user.pk},
-                                                     pks=True):
-                await self.channel_layer.group_send(
-                    f'user_{user_pk}',
-                    {
-                        'type': 'receive_json',
-                        'message_type': 'text',
-                        'message': message,
-                        'date_created': created,
-                        'sender': {
-                            'id': self.user.pk,
-                            'name': str(self.user)
-                        },
-                        'room_id': room_id,
-                    }
-                )
+    async def membership_changed(self, event):
+        self.members_pks.update(event['added'])
+        self.members_pks.difference_update(event['removed'])
+        if self.user.pk not in self.members_pks:
+            await self.close()
 
     async def send_to_websocket(self, event):
-        await self.send_json(event)
+        self.stop_typing(event['sender'])
+        await self.send_event(event)
 
 
-class AlertConsumer(AsyncJsonWebsocketConsumer):
+class AlertConsumer(CoalescingMixin, WireFormatMixin, AsyncJsonWebsocketConsumer):
     """
         WebSocket methods below
     """
     user = None
+    schema_name = None
+    multitenant = None
     user_group_name = None
+    rooms_groups_names = None
+    relayed_at = 0
+    # the rooms of the user, loaded on connect in the 'room' alerts fan-out
+    # or when `keep_rooms_pks` is set, and kept up to date
+    rooms_pks = None
+    keep_rooms_pks = False
 
     async def connect(self):
         self.user = self.scope['user']
-        self.user_group_name = f'user_{self.user.pk}'
+        self.schema_name = self.scope.get('schema_name', None)
+        self.multitenant = self.scope.get('multitenant', False)
+        self.user_group_name = get_user_group_name(self.user.pk)
+        self.rooms_groups_names = set()
         await self.channel_layer.group_add(
             self.user_group_name,
             self.channel_name
         )
+        if get_alert_fanout() == ROOM_FANOUT or self.keep_rooms_pks:
+            self.rooms_pks = set(await get_rooms_pks(self.user,
+                                                     self.multitenant,
+                                                     self.schema_name))
+        if get_alert_fanout() == ROOM_FANOUT:
+            await asyncio.gather(*[self.join_room_alerts(room_pk)
+                                   for room_pk in self.rooms_pks])
         await self.accept()
 
     async def disconnect(self, close_code):
@@ -187,13 +390,166 @@ class AlertConsumer(AsyncJsonWebsocketConsumer):
             self.user_group_name,
             self.channel_name
         )
+        await asyncio.gather(*[
+            self.channel_layer.group_discard(group_name, self.channel_name)
+            for group_name in self.rooms_groups_names
+        ])
 
-    async def receive_json(self, data, **kwargs):
-        # Check if the data has been sent to this consumer by the currently
-        # logged in user
+    async def join_room_alerts(self, room_pk):
+        group_name = get_room_alerts_group_name(room_pk)
+        self.rooms_groups_names.add(group_name)
+        await self.channel_layer.group_add(group_name, self.channel_name)
+
+    async def leave_room_alerts(self, room_pk):
+        group_name = get_room_alerts_group_name(room_pk)
+        self.rooms_groups_names.discard(group_name)
+        await self.channel_layer.group_discard(group_name, self.channel_name)
 
+    async def receive_json(self, data, **kwargs):
+        # Relays the data to the connections of the user. With CHATTER_PRESENCE
+        # enabled, it's dropped when the previous one was relayed less than
+        # 'min_interval' seconds ago: presence and typing are signaled by ChatConsumer.
+        config = get_presence_config()
+        if config['enabled']:
+            now = time.monotonic()
+            if now - self.relayed_at < config['min_interval']:
+                return
+            self.relayed_at = now
         data['type'] = 'send_to_websocket'
         await self.channel_layer.group_send(self.user_group_name, data)
 
+    async def room_alert(self, event):
+        if event['sender']['id'] != self.user.pk:
+            await self.send_event(event)
+
+    async def user_alert(self, event):
+        await self.send_event(event)
+
+    async def room_activity(self, event):
+        if event['sender']['id'] != self.user.pk:
+            await self.send_event(event)
+
+    async def room_joined(self, event):
+        if self.rooms_pks is not None:
+            self.rooms_pks.add(event['room_id'])
+        if get_alert_fanout() == ROOM_FANOUT:
+            await self.join_room_alerts(event['room_id'])
+
+    async def room_left(self, event):
+        if self.rooms_pks is not None:
+            self.rooms_pks.discard(event['room_id'])
+        if get_room_alerts_group_name(event['room_id']) in self.rooms_groups_names:
+            await self.leave_room_alerts(event['room_id'])
+
     async def send_to_websocket(self, event):
-        await self.send_json(event)
+        await self.send_event(event)
+
+
+def get_frame_int(data, name):
+    value = data.get(name)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
+
+class MultiplexConsumer(MessagesMixin, AlertConsumer):
+    """
+    A single websocket per user for all its rooms. It gets the alerts of
+    AlertConsumer, and the messages of the rooms the client subscribes to:
+        {'type': 'subscribe', 'room_id': ...} (with 'since_seq' or 'last_id'
+        to get the messages missed, like the query string of ChatConsumer)
+        {'type': 'unsubscribe', 'room_id': ...}
+    Messages are sent like to ChatConsumer, to a subscribed 'room_id'.
+    The user is authenticated and its rooms loaded once for all of them.
+    Presence and typing indicators need a ChatConsumer.
+    """
+    keep_rooms_pks = True
+    # room id -> (room, members pks) of the rooms subscribed to
+    subscriptions = None
+
+    async def connect(self):
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
+        self.subscriptions = {}
+        self.sent_messages = TTLCache(maxsize=256, ttl=3600)
+        await super().connect()
+
+    async def disconnect(self, close_code):
+        if self.subscriptions is None:
+            return
+        await super().disconnect(close_code)
+        await asyncio.gather(*[
+            self.channel_layer.group_discard(get_chat_group_name(room_id), self.channel_name)
+            for room_id in self.subscriptions
+        ])
+
+    async def receive_json(self, data, **kwargs):
+        frame_type = data.get('type')
+        room_id = str(data.get('room_id'))
+        if frame_type == 'subscribe':
+            await self.subscribe(room_id,
+                                 get_frame_int(data, 'since_seq'),
+                                 get_frame_int(data, 'last_id'))
+        elif frame_type == 'unsubscribe':
+            await self.unsubscribe(room_id)
+        elif data.get('message_type') == 'text':
+            if room_id not in self.subscriptions:
+                await self.send_json({'type': 'error', 'room_id': room_id,
+                                      'error': 'not subscribed'})
+                return
+            room, members_pks = self.subscriptions[room_id]
+            await self.send_message(room, members_pks, data)
+
+    async def subscribe(self, room_id, since_seq=None, last_id=None):
+        if room_id not in self.rooms_pks:
+            await self.send_json({'type': 'error', 'room_id': room_id,
+                                  'error': 'not a member'})
+            return
+        if room_id not in self.subscriptions:
+            room = await get_room(room_id, self.multitenant, self.schema_name)
+            members_pks = await get_members_pks(room, self.multitenant, self.schema_name)
+            self.subscriptions[room_id] = (room, members_pks)
+            await self.channel_layer.group_add(get_chat_group_name(room_id),
+                                               self.channel_name)
+        await self.send_json({'type': 'subscribed', 'room_id': room_id})
+        await self.send_history(self.subscriptions[room_id][0], since_seq, last_id)
+
+    async def unsubscribe(self, room_id):
+        if self.subscriptions.pop(room_id, None) is None:
+            return
+        await self.channel_layer.group_discard(get_chat_group_name(room_id),
+                                               self.channel_name)
+        await self.send_json({'type': 'unsubscribed', 'room_id': room_id})
+
+    async def membership_changed(self, event):
+        subscription = self.subscriptions.get(event['room_id'])
+        if subscription is not None:
+            room, members_pks = subscription
+            members_pks.update(event['added'])
+            members_pks.difference_update(event['removed'])
+            if self.user.pk not in members_pks:
+                await self.unsubscribe(event['room_id'])
+
+    async def room_left(self, event):
+        await super().room_left(event)
+        await self.unsubscribe(event['room_id'])
+
+    async def user_alert(self, event):
+        # the messages of the rooms subscribed to come from their group
+        if event['room_id'] not in self.subscriptions:
+            await super().user_alert(event)
+
+    async def room_alert(self, event):
+        if event['room_id'] not in self.subscriptions:
+            await super().room_alert(event)
+
+    async def room_activity(self, event):
+        if event['room_id'] not in self.subscriptions:
+            await super().room_activity(event)
+
+    async def ignore_event(self, event):
+        pass
+
+    # sent to the room group for its ChatConsumers
+    presence_announce = presence_leave = typing_changed = ignore_event
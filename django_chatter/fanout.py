@@ -0,0 +1,118 @@
+import asyncio
+
+from django.conf import settings
+
+from django_chatter.cache import TTLCache
+from django_chatter.compat import run_in_executor
+from django_chatter.utils import get_chatter_cache
+
+USER_FANOUT = 'user'
+ROOM_FANOUT = 'room'
+
+
+def get_alert_fanout():
+    """How alerts of new messages reach the members of a room:
+    'user' (default) sends one event to the `user_<pk>` group of every member,
+    concurrently instead of one after another.
+    'room' sends a single event to the `room_alerts_<room pk>` group, to which
+    AlertConsumer subscribes for every room of its user.
+    """
+    return getattr(settings, "CHATTER_ALERT_FANOUT", USER_FANOUT)
+
+
+def get_large_room_config():
+    """Rooms with more than `threshold` members (None, default, for no limit)
+    don't send an alert of each message to their members:
+    CHATTER_LARGE_ROOM = {'threshold': 1000, 'interval': 5, 'max_rooms': 10000}
+    Those with the room open get its messages, the others get a 'room_activity'
+    alert at most once every `interval` seconds, through the alerts fan-out.
+    Each process remembers the alerts of up to `max_rooms` rooms.
+    """
+    config = dict(getattr(settings, "CHATTER_LARGE_ROOM", {}))
+    config.setdefault('threshold', None)
+    config.setdefault('interval', 5)
+    config.setdefault('max_rooms', 10000)
+    return config
+
+
+def is_large_room(members_pks):
+    threshold = get_large_room_config()['threshold']
+    return threshold is not None and len(members_pks) > threshold
+
+
+def get_chat_group_name(room_pk):
+    return f'chat_{room_pk}'
+
+
+def get_user_group_name(user_pk):
+    return f'user_{user_pk}'
+
+
+def get_room_alerts_group_name(room_pk):
+    return f'room_alerts_{room_pk}'
+
+
+async def send_to_users(channel_layer, users_pks, event):
+    """Sends the event to the group of each user, all requests in flight at once.
+    MultiplexConsumer skips it for the rooms it's subscribed to."""
+    event = dict(event, type='user_alert')
+    await asyncio.gather(*[
+        channel_layer.group_send(get_user_group_name(user_pk), event)
+        for user_pk in users_pks
+    ])
+
+
+async def send_to_room_alerts(channel_layer, room_pk, event):
+    """Sends the event once to the alert topic of the room.
+    The receiving consumers skip it when their user is the sender."""
+    await channel_layer.group_send(get_room_alerts_group_name(room_pk),
+                                   dict(event, type='room_alert'))
+
+
+def get_room_activity_cache_key(schema_name, room_pk):
+    return f'chatter:activity:{schema_name}:{room_pk}'
+
+
+# (schema name, room pk) of the rooms whose activity this process sent less than an interval ago
+_activity_sent = None
+
+
+def get_activity_sent():
+    global _activity_sent
+    config = get_large_room_config()
+    if _activity_sent is None or (_activity_sent.maxsize, _activity_sent.ttl) != \
+            (config['max_rooms'], config['interval']):
+        _activity_sent = TTLCache(maxsize=config['max_rooms'], ttl=config['interval'])
+    return _activity_sent
+
+
+async def send_room_activity(channel_layer, room_pk, users_pks, event, schema_name=None):
+    """Tells the users that the room has new messages, unless it was done less
+    than CHATTER_LARGE_ROOM['interval'] seconds ago by any process (the first
+    to add the key of the room to CHATTER_CACHE sends it).
+    In the 'room' alerts fan-out, it's sent once to the alert topic of the room.
+    """
+    interval = get_large_room_config()['interval']
+    activity_sent = get_activity_sent()
+    key = (schema_name, str(room_pk))
+    if activity_sent.get(key):
+        return
+    activity_sent.set(key, True)
+    claimed = await run_in_executor(get_chatter_cache().add,
+                                    get_room_activity_cache_key(schema_name, room_pk),
+                                    True, interval)
+    if not claimed:
+        return
+    activity = {
+        'type': 'room_activity',
+        'room_id': str(room_pk),
+        'sender': event['sender'],
+        'date_created': event['date_created'],
+    }
+    if get_alert_fanout() == ROOM_FANOUT:
+        await channel_layer.group_send(get_room_alerts_group_name(room_pk), activity)
+    else:
+        await asyncio.gather(*[
+            channel_layer.group_send(get_user_group_name(user_pk), activity)
+            for user_pk in users_pks
+        ])
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+
+from django_chatter.models import Room
+
+
+class Command(BaseCommand):
+    help = "Stores the members fingerprint of the rooms created before fingerprints existed, " \
+           "so that create_room finds them."
+
+    def handle(self, *args, **options):
+        fingerprints = set(Room.objects.filter(members_fingerprint__isnull=False)
+                           .values_list('members_fingerprint', flat=True))
+        rooms_total = 0
+        # the oldest room of the same members is the one create_room returns
+        rooms = Room.objects.filter(members_fingerprint__isnull=True).order_by('date_created')
+        for room in rooms.iterator():
+            members_pks = list(room.members.values_list('pk', flat=True))
+            if not members_pks:
+                continue
+            fingerprint = Room.get_members_fingerprint(members_pks)
+            if fingerprint in fingerprints:
+                continue
+            fingerprints.add(fingerprint)
+            try:
+                with transaction.atomic():
+                    Room.objects.filter(pk=room.pk).update(members_fingerprint=fingerprint)
+            except IntegrityError:
+                # create_room made a room of the same members meanwhile
+                continue
+            rooms_total += 1
+        self.stdout.write(f"{rooms_total} rooms fingerprinted.")
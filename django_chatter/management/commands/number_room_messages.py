@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from django_chatter.models import Room
+
+
+class Command(BaseCommand):
+    help = "Numbers the messages of the rooms that have messages without a sequence number."
+
+    def handle(self, *args, **options):
+        rooms_total = 0
+        for room in Room.objects.filter(message__seq__isnull=True).distinct().iterator():
+            room.number_messages()
+            rooms_total += 1
+        self.stdout.write(f"Messages of {rooms_total} rooms numbered.")
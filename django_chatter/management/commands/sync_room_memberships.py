@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from django_chatter.models import Room
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the effective members of every room (direct and through groups)."
+
+    def handle(self, *args, **options):
+        added_total = removed_total = 0
+        for room in Room.objects.iterator():
+            added, removed = room.sync_memberships()
+            added_total += len(added)
+            removed_total += len(removed)
+        self.stdout.write(f"{added_total} memberships added, {removed_total} removed.")
@@ -1,8 +1,12 @@
 # coding: utf-8
+import hashlib
 import uuid
+from collections import OrderedDict
 
 from django.conf import settings
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils.text import Truncator
 from django.utils.module_loading import import_string
 from django.utils.translation import gettext as _
 from django.contrib.auth.models import Group
@@ -38,6 +42,14 @@ class DateTimeModel(models.Model):
         abstract = True
 
 
+LAST_MESSAGE_PREVIEW_LENGTH = 200
+CLIENT_ID_MAX_LENGTH = 64
+# unread messages counted at most, past it clients show e.g. "99+"
+UNREAD_COUNT_LIMIT = 99
+# members named in the title of a room without a name
+ROOM_NAME_MEMBERS_LIMIT = 20
+
+
 class Room(DateTimeModel):
     id = models.UUIDField(primary_key=True,
                           default=uuid.uuid4,
@@ -47,6 +59,13 @@ class Room(DateTimeModel):
                             null=True, blank=True)
     # deactivated rooms should not appear in lists.
     enabled = models.BooleanField(verbose_name="enabled", default=True)
+    # canonical hash of the sorted direct members of rooms made by `create_room`,
+    # used to find them with a single indexed lookup.
+    members_fingerprint = models.CharField(verbose_name=_("members fingerprint"),
+                                           max_length=64,
+                                           unique=True,
+                                           null=True, blank=True,
+                                           editable=False)
 
     members = models.ManyToManyField(settings.AUTH_USER_MODEL,
                                      verbose_name=_("members"),
@@ -58,14 +77,44 @@ class Room(DateTimeModel):
                                             related_name='members_groups',
                                             blank=True)
 
+    # denormalized copy of the latest message, maintained by `set_last_message`.
+    last_message = models.ForeignKey('Message',
+                                     verbose_name=_("last message"),
+                                     on_delete=models.SET_NULL,
+                                     related_name='+',
+                                     null=True, blank=True,
+                                     editable=False)
+    last_message_preview = models.CharField(verbose_name=_("last message preview"),
+                                            max_length=LAST_MESSAGE_PREVIEW_LENGTH,
+                                            blank=True, default='',
+                                            editable=False)
+    last_message_sender = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                            verbose_name=_("last message sender"),
+                                            on_delete=models.SET_NULL,
+                                            related_name='+',
+                                            null=True, blank=True,
+                                            editable=False)
+    last_message_date = models.DateTimeField(verbose_name=_("last message date"),
+                                             null=True, blank=True,
+                                             editable=False)
+    # sequence number of the latest message, see `Message.seq`
+    message_seq = models.PositiveIntegerField(verbose_name=_("message sequence"),
+                                              default=0,
+                                              editable=False)
+
     def __str__(self):
         if self.name:
             return self.name
-        members_limit = 20
-        members_qs = self.get_members_all()
-        members_total = members_qs.count()
+        members_limit = ROOM_NAME_MEMBERS_LIMIT
+        if 'memberships' in getattr(self, '_prefetched_objects_cache', {}):
+            # first memberships prefetched with their users and counted by the room lists
+            members = [membership.user for membership in self.memberships.all()]
+            members_total = getattr(self, 'members_count', len(members))
+        else:
+            members = self.get_members_all()
+            members_total = members.count()
         members_list = []
-        for member in members_qs[:members_limit]:
+        for member in members[:members_limit]:
             members_list.append(str(member))
         s = ", ".join(members_list)
         if members_total > members_limit:
@@ -76,20 +125,197 @@ class Room(DateTimeModel):
         """Checks whether the user is a member of the room
         :rtype bool
         """
-        return self.members.filter(pk=user.pk).exists() or \
-               self.members_groups.filter(user__pk=user.pk).exists()
+        return self.memberships.filter(user__pk=user.pk).exists()
 
     def get_members_all(self, excluding=None, pks=False):
         """Returns all members of the room following the configuration criteria"""
-        members = self.members.union(
-            self.members.model.objects.filter(
-                groups__in=self.members_groups.all()))
+        members = self.members.model.objects.filter(room_memberships__room=self)
         if excluding is not None:
             members = members.exclude(**excluding)
         if pks:
             members = members.values_list('pk', flat=pks)
         return members
 
+    @staticmethod
+    def get_members_fingerprint(users_pks):
+        """Returns the fingerprint of a set of members, regardless of their order"""
+        members = ",".join(sorted({str(pk) for pk in users_pks}))
+        return hashlib.sha256(members.encode('utf-8')).hexdigest()
+
+    def refresh_members_fingerprint(self):
+        """Drops the fingerprint when the members no longer match it"""
+        if self.members_fingerprint is None:
+            return
+        fingerprint = self.get_members_fingerprint(self.members.values_list('pk', flat=True))
+        if fingerprint != self.members_fingerprint:
+            self.members_fingerprint = None
+            Room.objects.filter(pk=self.pk).update(members_fingerprint=None)
+
+    def sync_memberships(self, users_pks=None):
+        """Brings RoomMembership in line with the members of the room, both direct
+        and through `members_groups`. Limited to `users_pks` when given.
+        Returns the primary keys of the added and removed members.
+        """
+        user_model = self.members.model
+        members = user_model.objects.filter(
+            Q(members=self) |
+            Q(groups__members_groups=self)
+        )
+        memberships = self.memberships.all()
+        if users_pks is not None:
+            members = members.filter(pk__in=users_pks)
+            memberships = memberships.filter(user__in=users_pks)
+        members_pks = set(members.values_list('pk', flat=True).distinct())
+        current_pks = set(memberships.values_list('user', flat=True))
+        added = members_pks - current_pks
+        removed = current_pks - members_pks
+        if removed:
+            memberships.filter(user__in=removed).delete()
+        if added:
+            RoomMembership.objects.bulk_create([
+                RoomMembership(room=self, user_id=user_pk) for user_pk in added
+            ])
+        return added, removed
+
+    def set_last_message(self, message):
+        """Stores the message as the latest one of the room with a single UPDATE.
+        An older message never replaces a newer one.
+        """
+        self.last_message = message
+        self.last_message_preview = Truncator(message.safe_text).chars(LAST_MESSAGE_PREVIEW_LENGTH)
+        self.last_message_sender_id = message.sender_id
+        self.last_message_date = message.date_created
+        self.date_modified = message.date_modified
+        fields = dict(last_message=message,
+                      last_message_preview=self.last_message_preview,
+                      last_message_sender=self.last_message_sender_id,
+                      last_message_date=self.last_message_date,
+                      date_modified=self.date_modified)
+        if message.seq is not None:
+            self.message_seq = fields['message_seq'] = message.seq
+        Room.objects.filter(pk=self.pk).filter(
+            Q(last_message__isnull=True) |
+            Q(last_message__lt=message.pk)
+        ).update(**fields)
+
+    def lock_message_seq(self):
+        """Locks the room until the end of the transaction and returns the
+        sequence number of its latest message"""
+        return Room.objects.select_for_update().filter(pk=self.pk) \
+            .values_list('message_seq', flat=True).get()
+
+    def take_message_seq(self, count=1):
+        """Reserves the next `count` sequence numbers of the room and returns the last one.
+        The UPDATE locks the room until the end of the transaction.
+        Raises Room.DoesNotExist if the room was deleted.
+        """
+        rooms = Room.objects.filter(pk=self.pk)
+        rooms.update(message_seq=F('message_seq') + count)
+        return rooms.values_list('message_seq', flat=True).get()
+
+    def has_unread(self, user):
+        """Checks whether the room has messages the user has not read yet
+        :rtype bool
+        """
+        if self.last_message_id is None or self.last_message_sender_id == user.pk:
+            # answering the room is reading it
+            return False
+        return not self.memberships.filter(user__pk=user.pk,
+                                           last_read_message__gte=self.last_message_id).exists()
+
+    def mark_read(self, user, message=None):
+        """Advances the read cursor of the user up to the message (the latest one by default).
+        The cursor never moves backwards.
+        """
+        if message is None:
+            message_pk = self.last_message_id or self.message_set.order_by('-id') \
+                .values_list('pk', flat=True).first()
+        else:
+            message_pk = message.pk
+        membership, created = RoomMembership.objects.get_or_create(room=self, user=user)
+        if message_pk is not None:
+            RoomMembership.objects.filter(pk=membership.pk).filter(
+                Q(last_read_message__isnull=True) |
+                Q(last_read_message__lt=message_pk)
+            ).update(last_read_message=message_pk)
+        return membership
+
+    def get_unread_count(self, user, limit=UNREAD_COUNT_LIMIT):
+        """Counts the messages sent by the others after the read cursor of the user
+        and after its own latest message, up to `limit`.
+        Nothing is counted when the messages are sent, only when asked.
+        """
+        read_pks = [
+            self.memberships.filter(user__pk=user.pk)
+                .values_list('last_read_message', flat=True).first(),
+            self.message_set.filter(sender__pk=user.pk).order_by('-pk')
+                .values_list('pk', flat=True).first(),
+        ]
+        read_pks = [pk for pk in read_pks if pk is not None]
+        messages = self.message_set.exclude(sender__pk=user.pk)
+        if read_pks:
+            messages = messages.filter(pk__gt=max(read_pks))
+        return messages.order_by()[:limit].count()
+
+    def number_messages(self):
+        """Numbers all the messages of the room in the order they were sent,
+        e.g. those stored before they had a sequence number, and stores the
+        latest one as the last message of the room"""
+        with transaction.atomic():
+            self.lock_message_seq()
+            messages_pks = list(self.message_set.order_by('date_created', 'id')
+                                .values_list('pk', flat=True))
+            self.message_set.update(seq=None)
+            # one UPDATE ... CASE for each 1000 messages (no bulk_update before Django 2.2)
+            for start in range(0, len(messages_pks), 1000):
+                batch = messages_pks[start:start + 1000]
+                Message.objects.filter(pk__in=batch).update(seq=Case(
+                    *[When(pk=pk, then=Value(seq)) for seq, pk in enumerate(batch, start + 1)],
+                    output_field=models.PositiveIntegerField()
+                ))
+            self.message_seq = len(messages_pks)
+            Room.objects.filter(pk=self.pk).update(message_seq=self.message_seq)
+            if messages_pks:
+                self.set_last_message(Message.objects.get(pk=messages_pks[-1]))
+
+    def add_message(self, sender, text, client_id=None, text_safe=None):
+        """Stores a new message in a single transaction: the sequence number
+        (`take_message_seq`), the INSERT of the message and one UPDATE for the room.
+        Raises IntegrityError if the sender already sent a message with `client_id`.
+        """
+        with transaction.atomic():
+            message = Message(room=self, sender=sender, text=text,
+                              client_id=client_id, text_safe=text_safe,
+                              seq=self.take_message_seq())
+            message.save(force_insert=True)
+            self.set_last_message(message)
+        return message
+
+    @staticmethod
+    def add_messages(messages):
+        """Stores a batch of new messages of one or more rooms in a single transaction,
+        with one bulk INSERT and one UPDATE of each room.
+        Messages of the same room must be in the order they were sent.
+        """
+        rooms = OrderedDict()
+        for message in messages:
+            rooms.setdefault(message.room_id, []).append(message)
+        with transaction.atomic():
+            # rooms locked in a fixed order, concurrent batches don't deadlock
+            for room_pk in sorted(rooms, key=str):
+                room_messages = rooms[room_pk]
+                seq = room_messages[0].room.take_message_seq(len(room_messages)) - len(room_messages)
+                for message in room_messages:
+                    seq += 1
+                    message.seq = seq
+            if connection.features.can_return_ids_from_bulk_insert:
+                Message.objects.bulk_create(messages)
+            else:
+                for message in messages:
+                    message.save(force_insert=True)
+            for room_messages in rooms.values():
+                room_messages[0].room.set_last_message(room_messages[-1])
+
     class Meta:
         verbose_name = _("Room")
         verbose_name_plural = _("Rooms")
@@ -104,6 +330,25 @@ class Message(DateTimeModel):
                              verbose_name=_("room"),
                              on_delete=models.CASCADE)
     text = get_text_field(verbose_name=_("text"))
+    # text after the sanitizers (django_chatter.sanitizers), rendered as is.
+    # Null when they left it unchanged; messages stored before it existed
+    # were sanitized in `text`.
+    text_safe = models.TextField(verbose_name=_("safe text"),
+                                 null=True, blank=True,
+                                 editable=False)
+    # position of the message in its room (1, 2, ...), assigned when it's stored
+    # with the room locked; clients use it to find missed messages.
+    # Messages stored before it existed don't have it.
+    seq = models.PositiveIntegerField(verbose_name=_("sequence"),
+                                      null=True, blank=True,
+                                      editable=False)
+    # id given by the client of the sender, so that a message sent again
+    # (e.g. after reconnecting) is stored only once.
+    client_id = models.CharField(verbose_name=_("client id"),
+                                 max_length=CLIENT_ID_MAX_LENGTH,
+                                 null=True, blank=True,
+                                 editable=False)
+    # deprecated: unread state is kept by the RoomMembership read cursors.
     recipients = models.ManyToManyField(settings.AUTH_USER_MODEL,
                                         verbose_name=_("recipients"),
                                         related_name='recipients')
@@ -111,7 +356,52 @@ class Message(DateTimeModel):
     def __str__(self):
         return _(f'sent by "{self.sender}" in room "{self.room}"')
 
+    @property
+    def safe_text(self):
+        """The text to render, sanitized when it was stored"""
+        return self.text if self.text_safe is None else self.text_safe
+
     class Meta:
         ordering = ['-date_created']
+        indexes = [
+            # history is read backwards from a (date_created, id) cursor
+            models.Index(fields=['room', 'date_created', 'id']),
+        ]
+        unique_together = (
+            ('room', 'seq'),
+            ('room', 'sender', 'client_id'),
+        )
         verbose_name = _("Message")
         verbose_name_plural = _("Messages")
+
+
+class RoomMembership(models.Model):
+    """Effective member of a room (direct or through a group) and its read cursor.
+    A message of another member is unread when it comes after the `last_read_message`
+    of the member and after its own latest message in the room.
+    """
+    room = models.ForeignKey(Room,
+                             verbose_name=_("room"),
+                             on_delete=models.CASCADE,
+                             related_name='memberships')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             verbose_name=_("user"),
+                             on_delete=models.CASCADE,
+                             related_name='room_memberships')
+    last_read_message = models.ForeignKey(Message,
+                                          verbose_name=_("last read message"),
+                                          on_delete=models.SET_NULL,
+                                          related_name='+',
+                                          null=True, blank=True)
+
+    def __str__(self):
+        return _(f'"{self.user}" in room "{self.room}"')
+
+    def get_unread_count(self, limit=UNREAD_COUNT_LIMIT):
+        """Counts the messages of the room after the read cursor, up to `limit`"""
+        return self.room.get_unread_count(self.user, limit=limit)
+
+    class Meta:
+        unique_together = ('room', 'user')
+        verbose_name = _("Room membership")
+        verbose_name_plural = _("Room memberships")
@@ -0,0 +1,153 @@
+import asyncio
+import atexit
+import logging
+import threading
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from django_chatter.models import Room, Message
+from django_chatter.utils import get_chatter_cache, tenant_context
+
+logger = logging.getLogger(__name__)
+
+
+def get_write_behind_config():
+    """Write-behind persistence of messages (disabled by default):
+    CHATTER_WRITE_BEHIND = {'enabled': True, 'flush_size': 100, 'flush_interval': 0.05,
+                            'client_id_timeout': 3600}
+    A message sent again with the same client id within `client_id_timeout` seconds
+    is recognized before it's broadcast.
+    """
+    config = dict(getattr(settings, "CHATTER_WRITE_BEHIND", {}))
+    config.setdefault('enabled', False)
+    config.setdefault('flush_size', 100)
+    config.setdefault('flush_interval', 0.05)
+    config.setdefault('client_id_timeout', 3600)
+    return config
+
+
+def get_client_id_cache_key(schema_name, room_pk, sender_pk, client_id):
+    return f'chatter:client-id:{schema_name}:{room_pk}:{sender_pk}:{client_id}'
+
+
+def claim_client_id(schema_name, room_pk, sender_pk, client_id, created):
+    """Claims the client id of a message written behind, in the cache shared by the
+    workers: the database only finds duplicates once they've been broadcast.
+    Returns None when the message is new, the creation date of the first one otherwise.
+    """
+    cache = get_chatter_cache()
+    cache_key = get_client_id_cache_key(schema_name, room_pk, sender_pk, client_id)
+    if cache.add(cache_key, created, get_write_behind_config()['client_id_timeout']):
+        return None
+    return cache.get(cache_key, created)
+
+
+class MessageWriteBuffer:
+    """In-process write-behind buffer of chat messages.
+
+    Consumers broadcast a message right away and add it here; a background task
+    stores the pending messages in batches (`Room.add_messages`) when `flush_size`
+    messages are waiting or after `flush_interval` seconds. Batches are written one
+    at a time in arrival order, so the messages of a room keep their order.
+    Pending messages are written on interpreter exit, but they are lost if the
+    process is killed. The stored `date_created` is the time of the flush.
+    """
+
+    def __init__(self, flush_size=100, flush_interval=0.05):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        self._loop = None
+        self._full = None
+        self._task = None
+        # a batch is taken and stored before the next one is taken
+        self._write_lock = threading.Lock()
+
+    def add(self, room, sender, text, schema_name=None, client_id=None, text_safe=None):
+        """Queues the message and returns its creation date"""
+        self.pending.append((schema_name, Message(room=room, sender=sender, text=text,
+                                                  client_id=client_id,
+                                                  text_safe=text_safe)))
+        self._start()
+        if len(self.pending) >= self.flush_size:
+            self._full.set()
+        return timezone.now()
+
+    def _start(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._full = asyncio.Event()
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self.pending:
+            if len(self.pending) < self.flush_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            await self.flush()
+
+    def take_batch(self):
+        batch = []
+        while self.pending and len(batch) < self.flush_size:
+            batch.append(self.pending.popleft())
+        return batch
+
+    def write_next(self):
+        """Stores the next batch, after the one being stored if any"""
+        with self._write_lock:
+            batch = self.take_batch()
+            if batch:
+                self.write(batch)
+
+    async def flush(self):
+        await database_sync_to_async(self.write_next)()
+
+    def drain(self):
+        """Synchronously stores everything still pending, once the batch being
+        stored by the background task is"""
+        while self.pending:
+            self.write_next()
+
+    def write(self, batch):
+        schemas = {}
+        for schema_name, message in batch:
+            schemas.setdefault(schema_name, []).append(message)
+        for schema_name, messages in schemas.items():
+            with tenant_context(schema_name is not None, schema_name):
+                try:
+                    Room.add_messages(messages)
+                except Exception:
+                    # find out which messages can't be stored instead of losing the batch
+                    logger.exception("django_chatter.persistence: batch of %d messages "
+                                     "failed, storing them one by one.", len(messages))
+                    for message in messages:
+                        message.pk = None
+                        try:
+                            Room.add_messages([message])
+                        except Exception:
+                            logger.exception("django_chatter.persistence: message from "
+                                             "%s in room %s dropped.",
+                                             message.sender_id, message.room_id)
+
+
+_write_buffer = None
+
+
+def get_write_buffer():
+    """Returns the write-behind buffer of the process"""
+    global _write_buffer
+    if _write_buffer is None:
+        config = get_write_behind_config()
+        _write_buffer = MessageWriteBuffer(flush_size=config['flush_size'],
+                                           flush_interval=config['flush_interval'])
+        atexit.register(_write_buffer.drain)
+    return _write_buffer
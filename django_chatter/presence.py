@@ -0,0 +1,255 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+from django_chatter.compat import run_in_executor
+from django_chatter.utils import get_chatter_cache
+
+
+def get_presence_config():
+    """Presence and typing indicators of the chat rooms (disabled by default),
+    never stored in the database:
+    CHATTER_PRESENCE = {'enabled': True, 'interval': 1.0, 'min_interval': 0.5,
+                        'typing_ttl': 6, 'online_ttl': 90}
+    Each websocket gets at most one 'presence' frame every `interval` seconds,
+    when the members online or typing in the room changed. The typing signals
+    of a connection less than `min_interval` seconds apart are dropped.
+    Users stop typing `typing_ttl` seconds after their last signal, and go
+    offline `online_ttl` seconds after their connection last renewed its entry
+    in the presence snapshot of the room (every third of it), e.g. when a
+    server dies.
+    """
+    config = dict(getattr(settings, "CHATTER_PRESENCE", {}))
+    config.setdefault('enabled', False)
+    config.setdefault('interval', 1.0)
+    config.setdefault('min_interval', 0.5)
+    config.setdefault('typing_ttl', 6)
+    config.setdefault('online_ttl', 90)
+    return config
+
+
+def get_presence_cache_key(schema_name, room_pk):
+    return f'chatter:presence:{schema_name}:{room_pk}'
+
+
+def update_presence_snapshot(schema_name, room_pk, channel_name, user, ttl):
+    """Renews the entry of the connection in the presence snapshot of the room,
+    kept in CHATTER_CACHE for all the workers (removes it when `user` is None),
+    and returns the snapshot: channel name -> (user, expires as a timestamp).
+    Concurrent renewals may overwrite each other: an entry lost this way is
+    back at the next renewal of its connection."""
+    cache = get_chatter_cache()
+    cache_key = get_presence_cache_key(schema_name, room_pk)
+    now = time.time()
+    snapshot = {channel: (entry_user, expires)
+                for channel, (entry_user, expires) in (cache.get(cache_key) or {}).items()
+                if expires > now}
+    if user is None:
+        snapshot.pop(channel_name, None)
+    else:
+        snapshot[channel_name] = (user, now + ttl)
+    if snapshot:
+        cache.set(cache_key, snapshot, ttl)
+    else:
+        cache.delete(cache_key)
+    return snapshot
+
+
+class RoomPresence:
+    """The connections online and the users typing in a room, as known by one
+    connection. Entries expire unless they're renewed."""
+
+    def __init__(self):
+        # channel name -> (user, expires)
+        self.online = {}
+        # user pk -> (user, expires)
+        self.typing = {}
+
+    def set_online(self, channel_name, user, ttl, now):
+        self.online[channel_name] = (user, now + ttl)
+
+    def set_offline(self, channel_name):
+        self.online.pop(channel_name, None)
+
+    def set_typing(self, user, typing, ttl, now):
+        if typing:
+            self.typing[user['id']] = (user, now + ttl)
+        else:
+            self.typing.pop(user['id'], None)
+
+    def expire(self, now):
+        for entries in (self.online, self.typing):
+            for key in [key for key, (user, expires) in entries.items() if expires <= now]:
+                del entries[key]
+
+    def next_expiry(self):
+        expiries = [expires for entries in (self.online, self.typing)
+                    for user, expires in entries.values()]
+        return min(expiries) if expiries else None
+
+    def get_state(self, now):
+        """The users online and typing, ordered by id"""
+        self.expire(now)
+        online = {user['id']: user for user, expires in self.online.values()}
+        return {
+            'online': [online[pk] for pk in sorted(online)],
+            'typing': [self.typing[pk][0] for pk in sorted(self.typing)],
+        }
+
+
+class PresenceMixin:
+    """Mixin for ChatConsumer (with CoalescingMixin): tells the other connections
+    of the room through its group when it comes and goes, and when its user
+    types, and sends the changes to the websocket in debounced 'presence' frames.
+    The connections online are read from the presence snapshot of the room,
+    renewed by each connection on its own: nothing is sent to the group but
+    the joins, the leaves and the typing signals.
+    """
+    presence = None
+    presence_sent = None
+    presence_sent_at = 0
+    presence_task = None
+    presence_due = None
+    renew_task = None
+    typing_sent = False
+    typing_sent_at = 0
+
+    def get_presence_user(self):
+        return {'id': self.user.pk, 'name': str(self.user)}
+
+    async def join_presence(self):
+        """Adds the connection to the presence snapshot of the room, which it
+        reads, and announces it to the connections already in the room"""
+        config = get_presence_config()
+        if not config['enabled']:
+            return
+        self.presence = RoomPresence()
+        await self.renew_presence()
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'presence_announce',
+            'channel': self.channel_name,
+            'user': self.get_presence_user(),
+        })
+        self.renew_task = asyncio.ensure_future(self.renew_later(config['online_ttl'] / 3))
+
+    async def renew_presence(self):
+        """Renews the entry of the connection in the presence snapshot and
+        renews the connections found there"""
+        ttl = get_presence_config()['online_ttl']
+        snapshot = await run_in_executor(update_presence_snapshot,
+                                         self.schema_name,
+                                         self.room.pk,
+                                         self.channel_name,
+                                         self.get_presence_user(),
+                                         ttl)
+        if self.presence is None:
+            return
+        now, wall_now = time.monotonic(), time.time()
+        for channel, (user, expires) in snapshot.items():
+            self.presence.set_online(channel, user, expires - wall_now, now)
+        self.schedule_presence()
+
+    async def renew_later(self, period):
+        while True:
+            await asyncio.sleep(period)
+            await self.renew_presence()
+
+    async def leave_presence(self):
+        if self.presence is None:
+            return
+        self.presence = None
+        for task in (self.renew_task, self.presence_task):
+            if task is not None:
+                task.cancel()
+        self.renew_task = self.presence_task = None
+        await run_in_executor(update_presence_snapshot,
+                              self.schema_name,
+                              self.room.pk,
+                              self.channel_name,
+                              None,
+                              get_presence_config()['online_ttl'])
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'presence_leave',
+            'channel': self.channel_name,
+            'user': self.get_presence_user(),
+        })
+
+    async def receive_typing(self, data):
+        """Tells the room that the user is typing (or stopped), unless nothing
+        changed or the connection sent the previous signal too recently"""
+        if self.presence is None:
+            return
+        config = get_presence_config()
+        typing = bool(data.get('typing', True))
+        now = time.monotonic()
+        if typing == self.typing_sent and \
+                (not typing or now - self.typing_sent_at < config['typing_ttl'] / 2):
+            return
+        if now - self.typing_sent_at < config['min_interval']:
+            return
+        self.typing_sent = typing
+        self.typing_sent_at = now
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'typing_changed',
+            'user': self.get_presence_user(),
+            'typing': typing,
+        })
+
+    def stop_typing(self, user):
+        """A message was sent by the user"""
+        if user['id'] == self.user.pk:
+            self.typing_sent = False
+        if self.presence is not None and user['id'] in self.presence.typing:
+            self.presence.set_typing(user, False, 0, time.monotonic())
+            self.schedule_presence()
+
+    async def presence_announce(self, event):
+        if self.presence is None:
+            return
+        self.presence.set_online(event['channel'], event['user'],
+                                 get_presence_config()['online_ttl'], time.monotonic())
+        self.schedule_presence()
+
+    async def presence_leave(self, event):
+        if self.presence is None:
+            return
+        self.presence.set_offline(event['channel'])
+        self.schedule_presence()
+
+    async def typing_changed(self, event):
+        if self.presence is None:
+            return
+        self.presence.set_typing(event['user'], event['typing'],
+                                 get_presence_config()['typing_ttl'], time.monotonic())
+        self.schedule_presence()
+
+    def schedule_presence(self, due=None):
+        """Sends the presence frame at `due` (monotonic time), or as soon as the
+        interval since the previous frame is over"""
+        if due is None:
+            due = self.presence_sent_at + get_presence_config()['interval']
+        if self.presence_task is not None:
+            if self.presence_due <= due:
+                return
+            self.presence_task.cancel()
+        self.presence_due = due
+        self.presence_task = asyncio.ensure_future(
+            self.send_presence_later(max(0, due - time.monotonic())))
+
+    async def send_presence_later(self, delay):
+        await asyncio.sleep(delay)
+        self.presence_task = None
+        if self.presence is None:
+            return
+        now = time.monotonic()
+        state = self.presence.get_state(now)
+        if state != self.presence_sent:
+            self.presence_sent = state
+            self.presence_sent_at = now
+            await self.send_event(dict(state, type='presence', room_id=str(self.room.pk)))
+        expiry = self.presence.next_expiry()
+        if expiry is not None:
+            # the frame telling that users went offline or stopped typing
+            self.schedule_presence(max(expiry, self.presence_sent_at +
+                                       get_presence_config()['interval']))
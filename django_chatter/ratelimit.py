@@ -0,0 +1,182 @@
+import logging
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+from django_chatter.compat import run_in_executor
+from django_chatter.utils import get_chatter_cache
+
+logger = logging.getLogger(__name__)
+
+USER_LIMIT = 'user'
+ROOM_LIMIT = 'room'
+
+
+def get_rate_limit_config():
+    """Token buckets limiting the messages sent (disabled by default):
+    CHATTER_RATE_LIMIT = {'backend': 'local', 'user': (1, 10), 'room': (20, 100)}
+    Each user, and all the users of a room together, may send `rate` messages
+    per second and up to `burst` at once, as (rate, burst); None for no limit.
+    'local' keeps the buckets in the memory of the process (up to `max_buckets`),
+    so the limits apply to each process. 'cache' keeps them in CHATTER_CACHE,
+    shared by the processes.
+    """
+    config = dict(getattr(settings, "CHATTER_RATE_LIMIT", {}))
+    config.setdefault('backend', None)
+    config.setdefault(USER_LIMIT, (1, 10))
+    config.setdefault(ROOM_LIMIT, (20, 100))
+    config.setdefault('max_buckets', 100000)
+    return config
+
+
+def take_token(state, rate, burst, now):
+    """Takes a token from the bucket in `state`, (tokens, time), None when full.
+    Returns the new state and 0, or the seconds to wait for a token if it's empty."""
+    if state is None:
+        tokens = burst
+    else:
+        tokens = min(burst, state[0] + (now - state[1]) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class LocalRateLimiter:
+    """Buckets in the memory of the process. The least recently used are dropped
+    beyond `max_buckets`, as if they were full."""
+    backend = 'local'
+
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self.throttled = Counter()
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, buckets):
+        """Takes a token from each of the buckets, (limit, key, rate, burst), or
+        from none of them. Returns None, or the first limit reached and the
+        seconds to wait for a token."""
+        now = time.monotonic()
+        with self._lock:
+            states = OrderedDict()
+            for limit, key, rate, burst in buckets:
+                states[key], wait = take_token(self._buckets.get(key), rate, burst, now)
+                if wait:
+                    return limit, wait
+            for key, state in states.items():
+                self._buckets.pop(key, None)
+                self._buckets[key] = state
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return None
+
+    def count_throttled(self, limit):
+        with self._lock:
+            self.throttled[limit] += 1
+
+    def get_throttled_counts(self):
+        with self._lock:
+            return dict(self.throttled)
+
+
+class CacheRateLimiter:
+    """Buckets in the Django cache, shared by the processes. The limits are
+    approximate: the buckets are read and written back without a lock, so
+    concurrent messages of different processes may both get the last token.
+    Buckets expire once they would be full again."""
+    backend = 'cache'
+
+    def take(self, buckets):
+        """Same as `LocalRateLimiter.take`, with one read of all the buckets"""
+        cache = get_chatter_cache()
+        now = time.time()
+        current = cache.get_many([key for limit, key, rate, burst in buckets])
+        states = {}
+        for limit, key, rate, burst in buckets:
+            states[key], wait = take_token(current.get(key), rate, burst, now)
+            if wait:
+                return limit, wait
+        for limit, key, rate, burst in buckets:
+            cache.set(key, states[key], math.ceil(burst / rate))
+        return None
+
+    def count_throttled(self, limit):
+        cache = get_chatter_cache()
+        key = get_throttled_cache_key(limit)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # evicted meanwhile
+            pass
+
+    def get_throttled_counts(self):
+        cache = get_chatter_cache()
+        return {limit: cache.get(get_throttled_cache_key(limit), 0)
+                for limit in (USER_LIMIT, ROOM_LIMIT)}
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """Returns the store of the token buckets, None if rate limiting is disabled"""
+    global _rate_limiter
+    config = get_rate_limit_config()
+    if config['backend'] is None:
+        return None
+    if _rate_limiter is None or _rate_limiter.backend != config['backend']:
+        if config['backend'] == 'cache':
+            _rate_limiter = CacheRateLimiter()
+        else:
+            _rate_limiter = LocalRateLimiter(max_buckets=config['max_buckets'])
+    return _rate_limiter
+
+
+def get_bucket_key(schema_name, limit, pk):
+    return f'chatter:bucket:{schema_name}:{limit}:{pk}'
+
+
+def get_throttled_cache_key(limit):
+    return f'chatter:throttled:{limit}'
+
+
+def get_throttled_counts():
+    """Metrics: the messages throttled by each limit, {'user': 3, 'room': 0}, since
+    the process started ('local') or the counters are in the cache ('cache')"""
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is None:
+        return {}
+    return rate_limiter.get_throttled_counts()
+
+
+def throttle(rate_limiter, user_pk, room_pk, schema_name=None):
+    config = get_rate_limit_config()
+    # a message refused by the room doesn't cost the user a token, and the other way round
+    buckets = [(limit, get_bucket_key(schema_name, limit, pk)) + tuple(config[limit])
+               for limit, pk in ((USER_LIMIT, user_pk), (ROOM_LIMIT, room_pk))
+               if config[limit] is not None]
+    if not buckets:
+        return None
+    throttled = rate_limiter.take(buckets)
+    if throttled is not None:
+        limit, wait = throttled
+        rate_limiter.count_throttled(limit)
+        logger.debug("django_chatter.ratelimit: message of user %s in room %s "
+                     "throttled by the %s limit.", user_pk, room_pk, limit)
+    return throttled
+
+
+async def throttle_message(user_pk, room_pk, schema_name=None):
+    """Takes a token from the buckets of the user and of the room. Returns None
+    when the message can be sent, else the limit reached ('user' or 'room') and
+    the seconds to wait before sending it again."""
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is None:
+        return None
+    if rate_limiter.backend == 'local':
+        return throttle(rate_limiter, user_pk, room_pk, schema_name)
+    return await run_in_executor(throttle, rate_limiter, user_pk, room_pk, schema_name)
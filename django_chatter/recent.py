@@ -0,0 +1,283 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+
+from django_chatter.utils import get_chatter_cache, get_schema_name, get_users_version
+
+# rough memory taken by a cached message besides its text
+MESSAGE_OVERHEAD = 300
+
+
+def get_recent_messages_config():
+    """Cache of the latest messages of the rooms (disabled by default):
+    CHATTER_RECENT_MESSAGES = {'backend': 'local', 'size': 50, 'max_bytes': 16 * 1024 * 1024}
+    'local' keeps them in the memory of the process, up to `max_bytes`; 'cache'
+    in the Django cache (CHATTER_CACHE) for `timeout` seconds.
+    """
+    config = dict(getattr(settings, "CHATTER_RECENT_MESSAGES", {}))
+    config.setdefault('backend', None)
+    config.setdefault('size', 50)
+    config.setdefault('max_bytes', 16 * 1024 * 1024)
+    config.setdefault('timeout', 3600)
+    return config
+
+
+class RecentSender:
+    """The sender of a cached message; its string is the name of the user"""
+    __slots__ = ('pk', 'name')
+
+    def __init__(self, pk, name):
+        self.pk = pk
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class RecentMessage:
+    """Cached copy of a message, with the attributes that templates and
+    `views.serialize_message` read from a Message (only its sanitized text)"""
+    __slots__ = ('pk', 'seq', 'safe_text', 'date_created', 'sender')
+
+    def __init__(self, pk, seq, safe_text, date_created, sender):
+        self.pk = pk
+        self.seq = seq
+        self.safe_text = safe_text
+        self.date_created = date_created
+        self.sender = sender
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.pk, message.seq, message.safe_text, message.date_created,
+                   RecentSender(message.sender_id, str(message.sender)))
+
+    def get_size(self):
+        return len(self.safe_text) + len(self.sender.name) + MESSAGE_OVERHEAD
+
+
+class RecentEntry:
+    """The latest messages of a room, newest first.
+    `complete` tells that the room has no older messages."""
+    __slots__ = ('messages', 'complete', 'users_version', 'size')
+
+    def __init__(self, messages, complete, users_version):
+        self.messages = tuple(messages)
+        self.complete = complete
+        self.users_version = users_version
+        self.size = sum(message.get_size() for message in self.messages)
+
+    @property
+    def last_message_id(self):
+        return self.messages[0].pk if self.messages else None
+
+    def is_latest(self, last_message_id):
+        """Whether the entry has the latest message of the room"""
+        if last_message_id is None:
+            return True
+        return self.last_message_id is not None and self.last_message_id >= last_message_id
+
+    def get_latest(self, count):
+        """The `count` latest messages, None if the entry doesn't have them all"""
+        if len(self.messages) >= count or self.complete:
+            return self.messages[:count]
+        return None
+
+
+class LocalRecentMessages:
+    """Entries in the memory of the process. The least recently used rooms are
+    dropped to keep the total size of the entries under `max_bytes`."""
+    backend = 'local'
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes and self._entries:
+                key, dropped = self._entries.popitem(last=False)
+                self.size -= dropped.size
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class CacheRecentMessages:
+    """Entries in the Django cache, shared by the processes and evicted by it"""
+    backend = 'cache'
+
+    def __init__(self, timeout=3600):
+        self.timeout = timeout
+
+    def get(self, key):
+        return get_chatter_cache().get(key)
+
+    def set(self, key, entry):
+        get_chatter_cache().set(key, entry, self.timeout)
+
+    def delete(self, key):
+        get_chatter_cache().delete(key)
+
+
+_recent_messages = None
+
+
+def get_recent_messages():
+    """Returns the store of the latest messages of the rooms, None if disabled"""
+    global _recent_messages
+    config = get_recent_messages_config()
+    if config['backend'] is None:
+        return None
+    if _recent_messages is None or _recent_messages.backend != config['backend']:
+        if config['backend'] == 'cache':
+            _recent_messages = CacheRecentMessages(timeout=config['timeout'])
+        else:
+            _recent_messages = LocalRecentMessages(max_bytes=config['max_bytes'])
+    return _recent_messages
+
+
+def get_recent_messages_key(schema_name, room_pk):
+    return f'chatter:recent:{schema_name}:{room_pk}'
+
+
+def load_entry(room, entry, users_version, size):
+    """Adds to the entry the messages stored after its latest one
+    (all of them if there's no entry), keeping the `size` latest"""
+    messages_qs = room.message_set.select_related('sender').order_by('-date_created', '-id')
+    if entry is not None and entry.messages:
+        latest = entry.messages[0]
+        messages_qs = messages_qs.filter(
+            Q(date_created__gt=latest.date_created) |
+            Q(date_created=latest.date_created, pk__gt=latest.pk)
+        )
+    newer = [RecentMessage.from_message(message) for message in messages_qs[:size + 1]]
+    if entry is None or len(newer) > size:
+        return RecentEntry(newer[:size], len(newer) <= size, users_version)
+    messages = newer + list(entry.messages)
+    return RecentEntry(messages[:size], entry.complete and len(messages) <= size,
+                       users_version)
+
+
+def get_entry(room):
+    recent_messages = get_recent_messages()
+    if recent_messages is None:
+        return None
+    config = get_recent_messages_config()
+    schema_name = get_schema_name()
+    key = get_recent_messages_key(schema_name, room.pk)
+    users_version = get_users_version(schema_name)
+    entry = recent_messages.get(key)
+    if entry is not None and entry.users_version != users_version:
+        # the names of the senders may have changed
+        entry = None
+    if entry is None or not entry.is_latest(room.last_message_id):
+        entry = load_entry(room, entry, users_version, config['size'])
+        recent_messages.set(key, entry)
+    return entry
+
+
+def get_latest_messages(room, count):
+    """The `count` latest messages of the room, newest first, from the cache.
+    None if the cache is disabled or doesn't hold that many messages."""
+    entry = get_entry(room)
+    if entry is None:
+        return None
+    return entry.get_latest(count)
+
+
+def remember_message(room, message):
+    """Adds the message just stored to the cached messages of its room.
+    Rooms that aren't cached are loaded on their next read."""
+    recent_messages = get_recent_messages()
+    if recent_messages is None:
+        return
+    key = get_recent_messages_key(get_schema_name(), room.pk)
+    entry = recent_messages.get(key)
+    if entry is None or entry.is_latest(message.pk):
+        return
+    size = get_recent_messages_config()['size']
+    latest = entry.messages[0] if entry.messages else None
+    if latest is not None and latest.seq is not None and message.seq == latest.seq + 1:
+        # nothing was stored in between
+        messages = (RecentMessage.from_message(message),) + entry.messages
+        entry = RecentEntry(messages[:size], entry.complete and len(messages) <= size,
+                            entry.users_version)
+    else:
+        # catching up from the database keeps the messages stored meanwhile
+        # by other processes
+        entry = load_entry(room, entry, entry.users_version, size)
+    recent_messages.set(key, entry)
+
+
+def forget_room_messages(schema_name, room_pk):
+    recent_messages = get_recent_messages()
+    if recent_messages is not None:
+        recent_messages.delete(get_recent_messages_key(schema_name, room_pk))
+
+
+def get_history(room, count, last_id=None, since_seq=None):
+    """Up to `count` messages of the room, oldest first: the latest ones, or the
+    first ones after the message `last_id` or the sequence number `since_seq` if
+    given. Also tells whether messages were left out: older ones than those
+    returned without `last_id` and `since_seq`, newer ones otherwise."""
+    entry = get_entry(room)
+    if entry is not None:
+        if last_id is None and since_seq is None:
+            if len(entry.messages) >= count or entry.complete:
+                return (entry.messages[:count][::-1],
+                        len(entry.messages) > count or not entry.complete)
+        else:
+            if since_seq is not None:
+                newer = [message for message in entry.messages
+                         if (message.seq or 0) > since_seq]
+            else:
+                newer = [message for message in entry.messages if message.pk > last_id]
+            # the entry reaches back to the last message seen
+            if len(newer) < len(entry.messages) or entry.complete:
+                return newer[::-1][:count], len(newer) > count
+    messages_qs = room.message_set.select_related('sender')
+    if since_seq is not None:
+        # a single range read of the (room, seq) unique index
+        messages_qs = messages_qs.filter(seq__gt=since_seq).order_by('seq')
+    elif last_id is not None:
+        messages_qs = messages_qs.order_by('date_created', 'id')
+        anchor = room.message_set.filter(pk=last_id).values_list('date_created', flat=True).first()
+        if anchor is None:
+            messages_qs = messages_qs.filter(pk__gt=last_id)
+        else:
+            messages_qs = messages_qs.filter(
+                Q(date_created__gt=anchor) |
+                Q(date_created=anchor, pk__gt=last_id)
+            )
+    else:
+        messages_qs = messages_qs.order_by('-date_created', '-id')
+    selected = list(messages_qs[:count + 1])
+    more = len(selected) > count
+    selected = selected[:count]
+    if last_id is None and since_seq is None:
+        selected.reverse()
+    return selected, more
@@ -5,5 +5,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     path(r'ws/django_chatter/chatrooms/(?P<room_uuid>.+)/$', consumers.ChatConsumer),
-    path(r'ws/django_chatter/users/(?P<user_id>\d+)/$', consumers.AlertConsumer)
+    path(r'ws/django_chatter/users/(?P<user_id>\d+)/$', consumers.AlertConsumer),
+    path(r'ws/django_chatter/multiplex/$', consumers.MultiplexConsumer),
 ]
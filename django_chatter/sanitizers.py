@@ -0,0 +1,72 @@
+import threading
+
+from bleach.sanitizer import Cleaner
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from django_chatter.compat import run_in_executor
+
+
+def get_sanitizers_config():
+    """Pipeline run once on each new message, before it's stored and sent:
+    CHATTER_SANITIZERS = ['django_chatter.sanitizers.clean_text']
+    Each sanitizer is called with the text and whether the client sent it as
+    HTML, and returns the text passed to the next one.
+    CHATTER_BLEACH_CLEANER holds the arguments of the bleach Cleaner shared by
+    the sanitizers (bleach defaults otherwise).
+    """
+    return {
+        'pipeline': tuple(getattr(settings, "CHATTER_SANITIZERS",
+                                  ['django_chatter.sanitizers.clean_text'])),
+        'cleaner': dict(getattr(settings, "CHATTER_BLEACH_CLEANER", {})),
+    }
+
+
+# Cleaner.clean isn't thread safe: each thread builds its own, once
+_cleaners = threading.local()
+
+
+def get_cleaner():
+    """The bleach Cleaner of the thread, built from CHATTER_BLEACH_CLEANER"""
+    config = get_sanitizers_config()['cleaner']
+    if getattr(_cleaners, 'config', None) != config:
+        _cleaners.cleaner = Cleaner(**config)
+        _cleaners.config = config
+    return _cleaners.cleaner
+
+
+def clean_text(text, html):
+    """Escapes the markup of the messages not sent as HTML (default)"""
+    if html:
+        return text
+    return get_cleaner().clean(text)
+
+
+def clean_html(text, html):
+    """Escapes the markup of all the messages, but the tags allowed by the Cleaner"""
+    return get_cleaner().clean(text)
+
+
+_pipeline = None
+_pipeline_paths = None
+
+
+def get_pipeline():
+    global _pipeline, _pipeline_paths
+    paths = get_sanitizers_config()['pipeline']
+    if _pipeline is None or _pipeline_paths != paths:
+        _pipeline = [import_string(path) for path in paths]
+        _pipeline_paths = paths
+    return _pipeline
+
+
+def sanitize(text, html=True):
+    """Runs the sanitizers on the text of a new message and returns the result"""
+    for sanitizer in get_pipeline():
+        text = sanitizer(text, html)
+    return text
+
+
+async def sanitize_async(text, html=True):
+    # the sanitizers don't touch the database: any thread of the pool will do
+    return await run_in_executor(sanitize, text, html)
@@ -0,0 +1,193 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from django_chatter.fanout import get_chat_group_name, get_user_group_name
+from django_chatter.models import Message, Room
+from django_chatter.recent import forget_room_messages
+from django_chatter.utils import (
+    forget_session_user,
+    get_schema_name,
+    tenants_cache,
+    touch_room_version,
+    touch_users_version,
+)
+
+User = get_user_model()
+
+
+def notify_memberships_changed(room, added, removed):
+    """Once the transaction is committed, tells the chat consumers of the room about
+    the members that joined or left it, and the alert consumers of these members
+    (which (un)subscribe from the room alerts in the 'room' alerts fan-out)"""
+    if not (added or removed):
+        return
+    room_pk = str(room.pk)
+    events = [(get_chat_group_name(room_pk), {'type': 'membership_changed',
+                                   'room_id': room_pk,
+                                   'added': list(added),
+                                   'removed': list(removed)})]
+    events += [(get_user_group_name(user_pk), {'type': 'room_joined', 'room_id': room_pk})
+               for user_pk in added]
+    events += [(get_user_group_name(user_pk), {'type': 'room_left', 'room_id': room_pk})
+               for user_pk in removed]
+    transaction.on_commit(lambda: send_to_groups(events))
+
+
+def send_to_groups(events):
+    """Sends (group name, event) pairs through the channel layer from synchronous code"""
+    channel_layer = get_channel_layer()
+
+    async def send():
+        for group_name, event in events:
+            await channel_layer.group_send(group_name, event)
+
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None and loop.is_running():
+        # ORM called from the event loop thread (e.g. in tests)
+        loop.create_task(send())
+    else:
+        async_to_sync(send)()
+
+
+def sync_room_memberships(room, users_pks=None):
+    added, removed = room.sync_memberships(users_pks=users_pks)
+    notify_memberships_changed(room, added, removed)
+
+
+def sync_rooms_memberships(rooms, users_pks=None):
+    for room in rooms:
+        sync_room_memberships(room, users_pks=users_pks)
+
+
+def get_changed_objects(instance, action, pk_set, model, cleared):
+    """Returns the objects on the other side of the relation changed by m2m_changed.
+    On `clear` they're remembered in `pre_clear` because `pk_set` is None.
+    """
+    if action == 'pre_clear':
+        instance._chatter_cleared = list(cleared)
+        return None
+    if action == 'post_clear':
+        return getattr(instance, '_chatter_cleared', [])
+    if action in ('post_add', 'post_remove'):
+        return model.objects.filter(pk__in=pk_set)
+    return None
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def room_members_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if reverse:
+        # user.members.add(room, ...)
+        rooms = get_changed_objects(instance, action, pk_set, model,
+                                    cleared=Room.objects.filter(members=instance))
+        if rooms is not None:
+            for room in rooms:
+                sync_room_memberships(room, users_pks=[instance.pk])
+                room.refresh_members_fingerprint()
+    else:
+        users = get_changed_objects(instance, action, pk_set, model,
+                                    cleared=instance.members.all())
+        if users is not None:
+            sync_room_memberships(instance, users_pks=[user.pk for user in users])
+            instance.refresh_members_fingerprint()
+
+
+@receiver(m2m_changed, sender=Room.members_groups.through)
+def room_members_groups_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if reverse:
+        # group.members_groups.add(room, ...)
+        rooms = get_changed_objects(instance, action, pk_set, model,
+                                    cleared=Room.objects.filter(members_groups=instance))
+        if rooms is not None:
+            sync_rooms_memberships(rooms, users_pks=instance.user_set.values_list('pk', flat=True))
+    else:
+        groups = get_changed_objects(instance, action, pk_set, model,
+                                     cleared=instance.members_groups.all())
+        if groups is not None:
+            sync_room_memberships(instance, users_pks=User.objects.filter(
+                groups__in=groups).values_list('pk', flat=True))
+
+
+def user_groups_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if reverse:
+        # group.user_set.add(user, ...)
+        users = get_changed_objects(instance, action, pk_set, model,
+                                    cleared=instance.user_set.all())
+        if users is not None:
+            sync_rooms_memberships(Room.objects.filter(members_groups=instance),
+                                   users_pks=[user.pk for user in users])
+    else:
+        groups = get_changed_objects(instance, action, pk_set, model,
+                                     cleared=instance.groups.all())
+        if groups is not None:
+            sync_rooms_memberships(Room.objects.filter(members_groups__in=groups).distinct(),
+                                   users_pks=[instance.pk])
+
+
+@receiver(pre_delete, sender=Group)
+def group_pre_delete(sender, instance, **kwargs):
+    """Deleting a group drops its rows of `members_groups` and `user_set` without
+    m2m_changed: the rooms and users are remembered until it's gone"""
+    instance._chatter_rooms = list(Room.objects.filter(members_groups=instance))
+    instance._chatter_users_pks = list(instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Group)
+def group_post_delete(sender, instance, **kwargs):
+    users_pks = getattr(instance, '_chatter_users_pks', None)
+    if users_pks:
+        sync_rooms_memberships(getattr(instance, '_chatter_rooms', []), users_pks=users_pks)
+
+
+# custom user models may not have groups (PermissionsMixin)
+if hasattr(User, 'groups'):
+    m2m_changed.connect(user_groups_changed, sender=User.groups.through)
+
+
+def clear_tenants_cache(sender, **kwargs):
+    tenants_cache.clear()
+
+
+if getattr(settings, 'TENANT_MODEL', None) and getattr(settings, 'TENANT_DOMAIN_MODEL', None):
+    from django_tenants.utils import get_tenant_domain_model, get_tenant_model
+
+    for tenant_model in (get_tenant_model(), get_tenant_domain_model()):
+        post_save.connect(clear_tenants_cache, sender=tenant_model)
+        post_delete.connect(clear_tenants_cache, sender=tenant_model)
+
+
+@receiver(user_logged_out)
+def forget_logged_out_session(sender, request, user, **kwargs):
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if session_key:
+        forget_session_user(get_schema_name(), session_key)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def touch_changed_users_version(sender, instance, update_fields=None, **kwargs):
+    # the date of the last login isn't listed
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    touch_users_version(get_schema_name())
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def forget_changed_room_messages(sender, instance, created=False, **kwargs):
+    # new messages reach the cache the next time their room is read
+    if not created:
+        schema_name = get_schema_name()
+        forget_room_messages(schema_name, instance.room_id)
+        touch_room_version(schema_name, instance.room_id)
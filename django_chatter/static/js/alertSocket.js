@@ -34,6 +34,17 @@ AI-------------------------------------------------------------------
 */
 alertSocket.onmessage = function (e) {
     var data = JSON.parse(e.data);
+    // coalesced alerts arrive together in an array
+    if (Array.isArray(data)) {
+        for (var i = 0; i < data.length; i++) {
+            displayAlert(data[i]);
+        }
+    } else {
+        displayAlert(data);
+    }
+}
+
+function displayAlert(data) {
     var message = data['message'];
     var sender = data['sender'];
     var received_room_id = data['room_id'];
@@ -46,8 +57,13 @@ alertSocket.onmessage = function (e) {
     // Highlight it
     $last_room.find('.chat-list-item').css('font-weight', 'bold');
 
-    // Add the new message preview
-    updateOpponentMessagePreview(received_room_id, sender, message);
+    // Add the new message preview. Large rooms only tell that they have
+    // new messages (room_activity), without them.
+    if (data['type'] === 'room_activity') {
+        updateOpponentMessagePreview(received_room_id, sender, 'new messages');
+    } else {
+        updateOpponentMessagePreview(received_room_id, sender, message);
+    }
 }
 
 //Notify when the websocket closes abruptly.
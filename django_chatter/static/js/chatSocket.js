@@ -9,7 +9,7 @@ AI-------------------------------------------------------------------
 -------------------------------------------------------------------AI
 */
 
-websocket_url = websocket_base_url + '/ws/django_chatter/chatrooms/' + room_id + '/';
+var chat_websocket_url = websocket_base_url + '/ws/django_chatter/chatrooms/' + room_id + '/';
 
 
 /*
@@ -17,38 +17,146 @@ AI-------------------------------------------------------------------
 	The following opens a websocket with the current URL,
 	sends messages to that websocket, receives and processes messages
 	that are sent back from the server.
+	When the websocket closes, it's opened again with the sequence
+	number (or id) of the latest message received, so the server sends
+	the missed messages.
 -------------------------------------------------------------------AI
 */
-var chatSocket = new WebSocket(
-    websocket_url
-);
-//Notify when the websocket is connected.
-chatSocket.onopen = function (e) {
-    console.log('Websocket connected.');
+var chatSocket = null;
+//Messages sent and not acknowledged yet, by client id.
+var pending_messages = {};
+
+function startChatSocket() {
+    var url = chat_websocket_url;
+    if (last_seq !== null) {
+        url += '?since_seq=' + last_seq;
+    } else if (last_message_id !== null) {
+        url += '?last_id=' + last_message_id;
+    }
+    chatSocket = new WebSocket(url);
+
+    //Notify when the websocket is connected.
+    chatSocket.onopen = function (e) {
+        console.log('Websocket connected.');
+        for (var client_id in pending_messages) {
+            chatSocket.send(JSON.stringify(pending_messages[client_id]));
+        }
+    }
+    chatSocket.onmessage = function (e) {
+        var data = JSON.parse(e.data);
+        // coalesced events arrive together in an array
+        if (Array.isArray(data)) {
+            for (var i = 0; i < data.length; i++) {
+                receiveFrame(data[i]);
+            }
+        } else {
+            receiveFrame(data);
+        }
+    }
+    //Reconnect when the websocket closes abruptly.
+    chatSocket.onclose = function (e) {
+        console.log('WebSocket disconnected.');
+        if (!e.wasClean) {
+            setTimeout(startChatSocket, 5000);
+        }
+    }
+}
+
+function receiveFrame(data) {
+    if (data['type'] === 'ack') {
+        delete pending_messages[data['client_id']];
+    } else if (data['type'] === 'throttled') {
+        resendLater(data['client_id'], data['retry_after']);
+    } else if (data['type'] === 'history') {
+        for (var i = 0; i < data['messages'].length; i++) {
+            displayMessage(data['messages'][i], true);
+        }
+        // the page was rendered without messages
+        if (messages_before === null && data['more'] && data['messages'].length) {
+            messages_before = data['messages'][0]['id'];
+        }
+        // more messages were missed than a frame holds: the next ones
+        if (data['resume']) {
+            resumeChatSocket();
+        }
+    } else if (data['type'] === 'presence') {
+        displayPresence(data);
+    } else {
+        displayMessage(data);
+    }
+}
+
+//Shows who else is online and typing in the room.
+function displayPresence(data) {
+    var names = function (users) {
+        return $.map(users, function (user) {
+            return user.id === user_session.id ? null : user.name;
+        });
+    };
+    var online = names(data['online']);
+    var typing = names(data['typing']);
+    var text = '';
+    if (typing.length) {
+        text = typing.join(', ') + (typing.length > 1 ? ' are typing...' : ' is typing...');
+    } else if (online.length) {
+        text = 'Online: ' + online.join(', ');
+    }
+    $('#room-presence').text(text);
+}
+
+// Sends again a message the server refused because too many were sent.
+function resendLater(client_id, retry_after) {
+    setTimeout(function () {
+        var data = pending_messages[client_id];
+        if (data && chatSocket.readyState === WebSocket.OPEN) {
+            chatSocket.send(JSON.stringify(data));
+        }
+    }, retry_after * 1000);
+}
+
+// Opens the websocket again to get the messages that were missed.
+function resumeChatSocket() {
+    chatSocket.onclose = null;
+    chatSocket.close();
+    startChatSocket();
 }
 
 /*
 AI-------------------------------------------------------------------
 	When a message is received:
-	1) Parse the message.
+	1) Skip it if it was displayed already (e.g. sent again after
+		reconnecting). If messages were missed before it (its sequence
+		number isn't the next one), resume the websocket instead.
 	2) Find out who the sender is.
 	3) Store the message text.
-	4) If there is a warning, store it.
-	5) If the message is sent by the user logged into the session,
+	4) If the message is sent by the user logged into the session,
 		apply the correct classes to the message so it's displayed
 		to the right.
-	6) If the message is sent by a different user, apply the correct
+	5) If the message is sent by a different user, apply the correct
 		classes to the message so it's displayed to the left.
-	7) If there are warnings in step 5 and 6, append it to the dialog
-		after the corresponding message.
-	8) Clear the input textarea for the current user to send a new
-		chat message.
-	9) After the messages have been rendered, scroll down to the bottom
+	6) After the messages have been rendered, scroll down to the bottom
 		of the dialog to the latest messages that have been sent.
 -------------------------------------------------------------------AI
 */
-chatSocket.onmessage = function (e) {
-    var data = JSON.parse(e.data);
+function displayMessage(data, from_history) {
+    var seq = data['seq'];
+    if (seq !== undefined && seq !== null) {
+        if (last_seq !== null && seq <= last_seq) {
+            return;
+        }
+        if (last_seq !== null && seq > last_seq + 1 && !from_history) {
+            resumeChatSocket();
+            return;
+        }
+        last_seq = seq;
+    }
+    var message_id = data['id'];
+    if (message_id !== undefined && message_id !== null) {
+        if (last_message_id !== null && message_id <= last_message_id) {
+            return;
+        }
+        last_message_id = message_id;
+    }
     var message = data['message'];
     var sender = data['sender'];
     var received_room_id = data['room_id'];
@@ -68,30 +176,59 @@ chatSocket.onmessage = function (e) {
         = document.getElementById('chat-dialog').scrollHeight;
 }
 
-//Notify when the websocket closes abruptly.
-chatSocket.onclose = function () {
-    console.log('WebSocket disconnected.');
-    //setTimeout(function(){startWebSocket(websocket_url)}, 5000);
-}
+startChatSocket();
 
 //When the enter key is pressed on the textarea, trigger a click
 //on the Send button.
+//Other keys tell the room that the user is typing.
 $('#send-message').keyup(function (e) {
     if (e.which === 13) {
         $('#send-button').trigger('click');
+    } else if ($.trim($("#send-message").val())) {
+        sendTyping();
     }
 });
 
+//The server forgets the signal after a few seconds: it's sent again
+//every 2 seconds while the user keeps typing.
+var typing_sent_at = 0;
+
+function sendTyping() {
+    var now = Date.now();
+    if (now - typing_sent_at < 2000 || chatSocket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    typing_sent_at = now;
+    chatSocket.send(JSON.stringify({
+        'message_type': 'typing',
+        'room_id': room_id,
+        'sender': user_session
+    }));
+}
+
+//Random id of a message, so that the server stores it only once when it's sent again.
+function newClientId() {
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
 //When the Send button is clicked, check if its just an empty message (i.e. only spaces).
 //If it is, don't send the message. Otherwise, send it to the websocket.
+//The message is sent again after reconnecting until the server acknowledges it.
 $('#send-button').click(function () {
     if ($.trim($("#send-message").val())) {
         var message = $('#send-message').val();
-        chatSocket.send(JSON.stringify({
+        var data = {
             'message_type': 'text',
             'message': message,
             'room_id': room_id,
-            'sender': user_session
-        }));
+            'sender': user_session,
+            'client_id': newClientId()
+        };
+        pending_messages[data['client_id']] = data;
+        // sending the message stops the typing signal
+        typing_sent_at = 0;
+        if (chatSocket.readyState === WebSocket.OPEN) {
+            chatSocket.send(JSON.stringify(data));
+        }
     }
 });
@@ -3,7 +3,8 @@
 
 var didScroll = false;
 
-var pageNum = 2;
+// True while a request is in flight so that the same page isn't fetched twice.
+var fetching = false;
 
 $('#chat-dialog').scroll(function () {
     didScroll = true;
@@ -20,11 +21,11 @@ setInterval(function () {
 function checkAndFetch() {
     // Check your page position and then
     // Load in more results
-    if ($('#chat-dialog').scrollTop() === 0) {
-        // $first_message = $('.message').not('.message-date-created').first();
-
-        // room_id is defined in the templates
-        get_url = get_room_url + '?page=' + pageNum;
+    // messages_before (the cursor of the oldest message displayed) is defined
+    // in the templates. It is null once the whole history has been loaded.
+    if ($('#chat-dialog').scrollTop() === 0 && messages_before !== null && !fetching) {
+        fetching = true;
+        get_url = get_room_url + '?before=' + messages_before;
         fetch(get_url, {
             credentials: 'same-origin',
             headers: {
@@ -36,7 +37,7 @@ function checkAndFetch() {
                 return response.json();
             })
             .then(function (myJson) {
-                myJson.forEach(function (object) {
+                myJson['messages'].forEach(function (object) {
                     savedScrollTop = $('#chat-dialog').scrollTop();
                     message = object['message'];
                     sender = object['sender'];
@@ -52,7 +53,11 @@ function checkAndFetch() {
                     $first_message = $('.message').not('.message-date-created').first();
                     $('#chat-dialog').scrollTop(savedScrollTop + $first_message.prop("scrollHeight"));
                 });
-                pageNum++;
+                messages_before = myJson['next_before'];
+                fetching = false;
+            })
+            .catch(function () {
+                fetching = false;
             });
     }
 }
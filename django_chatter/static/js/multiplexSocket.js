@@ -0,0 +1,118 @@
+/*
+AI-------------------------------------------------------------------
+	Optional client of the multiplexed websocket
+	(/ws/django_chatter/multiplex/): a single connection for the alerts
+	and the messages of all the rooms, instead of chatSocket.js and
+	alertSocket.js.
+
+		var socket = new MultiplexSocket(websocket_base_url, {
+			onMessage: function (data) {...},  // messages, history and alerts
+			onFrame: function (data) {...}     // any other frame (ack, error...)
+		});
+		socket.subscribe(room_id);
+		socket.send(room_id, {'message_type': 'text', 'message': 'Hello!'});
+		socket.unsubscribe(room_id);
+
+	The rooms are subscribed again after reconnecting, from the sequence
+	number of the latest message received, so the missed messages are sent.
+-------------------------------------------------------------------AI
+*/
+function MultiplexSocket(base_url, handlers) {
+    this.url = base_url + '/ws/django_chatter/multiplex/';
+    this.handlers = handlers || {};
+    //Sequence number of the latest message received, by subscribed room id.
+    this.rooms = {};
+    this.socket = null;
+    this.connect();
+}
+
+MultiplexSocket.prototype.connect = function () {
+    var self = this;
+    this.socket = new WebSocket(this.url);
+    this.socket.onopen = function () {
+        for (var room_id in self.rooms) {
+            self.sendSubscribe(room_id);
+        }
+    };
+    this.socket.onmessage = function (e) {
+        var data = JSON.parse(e.data);
+        // coalesced events arrive together in an array
+        if (!Array.isArray(data)) {
+            data = [data];
+        }
+        for (var i = 0; i < data.length; i++) {
+            self.receiveFrame(data[i]);
+        }
+    };
+    //Reconnect when the websocket closes abruptly.
+    this.socket.onclose = function (e) {
+        if (!e.wasClean) {
+            setTimeout(function () {
+                self.connect();
+            }, 5000);
+        }
+    };
+};
+
+MultiplexSocket.prototype.receiveFrame = function (data) {
+    if (data['type'] === 'history') {
+        for (var i = 0; i < data['messages'].length; i++) {
+            this.receiveMessage(data['messages'][i]);
+        }
+        // more messages were missed than a frame holds: the next ones
+        if (data['resume'] && data['room_id'] in this.rooms) {
+            this.sendSubscribe(data['room_id']);
+        }
+    } else if (data['message_type'] === 'text') {
+        this.receiveMessage(data);
+    } else {
+        if (data['type'] === 'unsubscribed') {
+            delete this.rooms[data['room_id']];
+        }
+        if (this.handlers.onFrame) {
+            this.handlers.onFrame(data);
+        }
+    }
+};
+
+MultiplexSocket.prototype.receiveMessage = function (data) {
+    var room_id = data['room_id'];
+    if (room_id in this.rooms && data['seq'] !== null && data['seq'] !== undefined) {
+        if (this.rooms[room_id] !== null && data['seq'] <= this.rooms[room_id]) {
+            return;
+        }
+        this.rooms[room_id] = data['seq'];
+    }
+    if (this.handlers.onMessage) {
+        this.handlers.onMessage(data);
+    }
+};
+
+MultiplexSocket.prototype.sendFrame = function (data) {
+    if (this.socket.readyState === WebSocket.OPEN) {
+        this.socket.send(JSON.stringify(data));
+    }
+};
+
+MultiplexSocket.prototype.sendSubscribe = function (room_id) {
+    var data = {'type': 'subscribe', 'room_id': room_id};
+    if (this.rooms[room_id] !== null) {
+        data['since_seq'] = this.rooms[room_id];
+    }
+    this.sendFrame(data);
+};
+
+MultiplexSocket.prototype.subscribe = function (room_id, last_seq) {
+    this.rooms[room_id] = last_seq === undefined ? null : last_seq;
+    this.sendSubscribe(room_id);
+};
+
+MultiplexSocket.prototype.unsubscribe = function (room_id) {
+    delete this.rooms[room_id];
+    this.sendFrame({'type': 'unsubscribe', 'room_id': room_id});
+};
+
+MultiplexSocket.prototype.send = function (room_id, data) {
+    data['room_id'] = room_id;
+    this.sendFrame(data);
+};
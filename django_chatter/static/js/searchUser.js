@@ -1,9 +1,8 @@
 /*
 AI-------------------------------------------------------------------
-	This script makes an AJAX call to get a list of registered
-	users. After that, the list is displayed dynamically using
-	JQuery Select2 so that when a user is typing a username, the user
-	can access these recipient users.
+	This script searches registered users with AJAX calls as
+	the user types a username. The matches are displayed using
+	JQuery Select2 so that the user can pick a recipient.
 -------------------------------------------------------------------AI
 */
 
@@ -14,26 +13,28 @@ var ws_or_wss = window.location.protocol == "https:" ? "wss://" : "ws://";
 /*
 AI-------------------------------------------------------------------
 	Once the page loads, the following function is run.
-	It fetches users list populates the select element with
-	the list
+	It sets the select element up to search users on the server
+	as the user types.
 -------------------------------------------------------------------AI
 */
 $(function () {
-
-    $.ajax({
-        //The url to send the request to
-        // url: '/chat/ajax/users-list/',
-        url: get_user_url,
-        /*If the request succeeds, there is data sent back from
-        the server in JSON format: [{'id': int, 'text': str}...]*/
-        success: function (data) {
-            // populate(data.userslist);
-            // linkuser(data.userslist);
-            $('.select-chat-user').select2({
-                placeholder: 'Start chat',
-                data: data,
-                width: 'resolve',
-            });
+    $('.select-chat-user').select2({
+        placeholder: 'Start chat',
+        width: 'resolve',
+        minimumInputLength: 1,
+        ajax: {
+            //The url to send the request to
+            url: get_user_url,
+            dataType: 'json',
+            delay: 250,
+            data: function (params) {
+                return {
+                    q: params.term,
+                    page: params.page || 1
+                };
+            }
+            /*The server answers in the format Select2 expects:
+            {'results': [{'id': int, 'text': str}...], 'pagination': {'more': bool}}*/
         }
     });
 });
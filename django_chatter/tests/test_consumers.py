@@ -1,4 +1,7 @@
+import asyncio
+
 import pytest
+from channels.db import database_sync_to_async
 from channels.testing import WebsocketCommunicator
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -6,6 +9,7 @@ from django.test import Client
 
 from chatter.routing import application, multitenant_application
 from django_chatter.models import Room, Message
+from django_chatter.persistence import MessageWriteBuffer, get_write_buffer
 from functional_tests.data_setup_for_tests import set_up_data
 
 TEST_CHANNEL_LAYERS = {
@@ -183,3 +187,705 @@ async def test_chat_alert_consumer():
     assert alert['sender'] == "user0"
     assert alert['room_id'] == str(room_with_two.id)
     await user1_alert_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_alert_consumer_room_fanout():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_ALERT_FANOUT = 'room'
+    try:
+        client, room, user = prepare_room_and_user()
+        user1 = get_user_model().objects.get(username="user1")
+        other_client = Client()
+        other_client.force_login(user=user1)
+        room_with_two = Room.objects.create()
+        room_with_two.members.add(*[user, user1])
+
+        chat_communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room_with_two.id}/",
+            headers=[
+                (
+                    b'cookie',
+                    f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+                ),
+                (b'host', b'localhost:8000')]
+        )
+        connected, subprotocol = await chat_communicator.connect()
+        assert connected
+
+        alert_communicators = []
+        for session_client, alert_user in ((client, user), (other_client, user1)):
+            alert_communicator = WebsocketCommunicator(
+                application, f"/ws/django_chatter/users/{alert_user.pk}/",
+                headers=[
+                    (
+                        b'cookie',
+                        f'sessionid={session_client.cookies["sessionid"].value}'.encode('ascii')
+                    ),
+                    (b'host', b'localhost:8000')]
+            )
+            connected, subprotocol = await alert_communicator.connect()
+            assert connected
+            alert_communicators.append(alert_communicator)
+        user_alert_communicator, user1_alert_communicator = alert_communicators
+
+        data = {
+            'message_type': 'text',
+            'message': "Hello!",
+            'sender': {'id': user.pk, 'name': user.username},
+            'room_id': str(room_with_two.id),
+        }
+        await chat_communicator.send_json_to(data)
+        response = await chat_communicator.receive_json_from()
+        alert = await user1_alert_communicator.receive_json_from()
+        assert response['message'] == "Hello!"
+        assert alert['message'] == "Hello!"
+        assert alert['room_id'] == str(room_with_two.id)
+        # the sender doesn't get an alert of its own message
+        assert await user_alert_communicator.receive_nothing()
+
+        await chat_communicator.disconnect()
+        for alert_communicator in alert_communicators:
+            await alert_communicator.disconnect()
+    finally:
+        del settings.CHATTER_ALERT_FANOUT
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_membership_changed():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    client, room, user = prepare_room_and_user()
+    user1 = get_user_model().objects.get(username="user1")
+    communicator = WebsocketCommunicator(
+        application, f"/ws/django_chatter/chatrooms/{room.id}/",
+        headers=[
+            (
+                b'cookie',
+                f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+            ),
+            (b'host', b'localhost:8000')]
+    )
+    connected, subprotocol = await communicator.connect()
+    assert connected
+
+    await database_sync_to_async(room.members.add)(user1)
+    await database_sync_to_async(room.members.remove)(user)
+    # the connection is closed once the user leaves the room
+    output = await communicator.receive_output()
+    assert output['type'] == 'websocket.close'
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_history():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_CONNECT_HISTORY = 2
+    client, room, user = prepare_room_and_user()
+    messages = [room.add_message(user, f"Message {i}") for i in range(4)]
+    headers = [
+        (
+            b'cookie',
+            f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+        ),
+        (b'host', b'localhost:8000')]
+    try:
+        communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/",
+            headers=headers
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'history'
+        assert [message['id'] for message in response['messages']] == \
+               [messages[2].pk, messages[3].pk]
+        assert response['more']
+        await communicator.disconnect()
+
+        # reconnecting after the message 1 was seen
+        communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/?last_id={messages[1].pk}",
+            headers=headers
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert [message['message'] for message in response['messages']] == \
+               ["Message 2", "Message 3"]
+        assert not response['more']
+        await communicator.disconnect()
+
+        # resuming after the sequence number of the message 2
+        communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/?since_seq={messages[2].seq}",
+            headers=headers
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert [message['seq'] for message in response['messages']] == [messages[3].seq]
+        await communicator.send_json_to({
+            'message_type': 'text',
+            'message': "Hello!",
+            'sender': {'id': user.pk, 'name': user.username},
+            'room_id': str(room.id),
+        })
+        response = await communicator.receive_json_from()
+        assert response['seq'] == messages[3].seq + 1
+        await communicator.disconnect()
+
+        # more messages missed than the resume limit: the oldest ones first
+        settings.CHATTER_RESUME_LIMIT = 2
+        communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/?since_seq={messages[0].seq}",
+            headers=headers
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert [message['message'] for message in response['messages']] == \
+               ["Message 1", "Message 2"]
+        assert response['resume']
+        assert not response['more']
+        await communicator.disconnect()
+    finally:
+        del settings.CHATTER_CONNECT_HISTORY
+        if hasattr(settings, 'CHATTER_RESUME_LIMIT'):
+            del settings.CHATTER_RESUME_LIMIT
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_client_id():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    client, room, user = prepare_room_and_user()
+    headers = [
+        (
+            b'cookie',
+            f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+        ),
+        (b'host', b'localhost:8000')]
+    data = {
+        'message_type': 'text',
+        'message': "Hello!",
+        'sender': {'id': user.pk, 'name': user.username},
+        'room_id': str(room.id),
+        'client_id': "a1b2c3",
+    }
+    communicator = WebsocketCommunicator(
+        application, f"/ws/django_chatter/chatrooms/{room.id}/",
+        headers=headers
+    )
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    await communicator.send_json_to(data)
+    ack = await communicator.receive_json_from()
+    assert ack['type'] == 'ack'
+    assert ack['client_id'] == "a1b2c3"
+    assert not ack['duplicate']
+    response = await communicator.receive_json_from()
+    assert response['id'] == ack['id']
+    await communicator.disconnect()
+
+    # sent again after reconnecting: acknowledged, not stored nor sent
+    communicator = WebsocketCommunicator(
+        application, f"/ws/django_chatter/chatrooms/{room.id}/",
+        headers=headers
+    )
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    await communicator.send_json_to(data)
+    ack = await communicator.receive_json_from()
+    assert ack['duplicate']
+    assert await communicator.receive_nothing()
+    assert await database_sync_to_async(Message.objects.count)() == 1
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_stores_sanitized_text():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    client, room, user = prepare_room_and_user()
+    communicator = WebsocketCommunicator(
+        application, f"/ws/django_chatter/chatrooms/{room.id}/",
+        headers=[
+            (
+                b'cookie',
+                f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+            ),
+            (b'host', b'localhost:8000')]
+    )
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        'message_type': 'text',
+        'message': "<script>evil();</script>",
+        'html': False,
+        'sender': {'id': user.pk, 'name': user.username},
+        'room_id': str(room.id),
+    })
+    response = await communicator.receive_json_from()
+    assert response['message'] == "&lt;script&gt;evil();&lt;/script&gt;"
+    await communicator.disconnect()
+    # sanitized once, the text as sent is kept alongside
+    message = await database_sync_to_async(Message.objects.get)(room=room)
+    assert message.text == "<script>evil();</script>"
+    assert message.safe_text == "&lt;script&gt;evil();&lt;/script&gt;"
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_coalescing():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_COALESCING = {'enabled': True, 'window': 1, 'max_events': 2}
+    client, room, user = prepare_room_and_user()
+    try:
+        communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/",
+            headers=[
+                (
+                    b'cookie',
+                    f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+                ),
+                (b'host', b'localhost:8000')]
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        for text in ("Hello!", "How are you?"):
+            await communicator.send_json_to({
+                'message_type': 'text',
+                'message': text,
+                'sender': {'id': user.pk, 'name': user.username},
+                'room_id': str(room.id),
+            })
+        # both events in a single frame
+        response = await communicator.receive_json_from()
+        assert [event['message'] for event in response] == ["Hello!", "How are you?"]
+        await communicator.disconnect()
+    finally:
+        del settings.CHATTER_COALESCING
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_presence():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_PRESENCE = {'enabled': True, 'interval': 0.1, 'typing_ttl': 0.5}
+    client, room, user = prepare_room_and_user()
+    try:
+        communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/",
+            headers=[
+                (
+                    b'cookie',
+                    f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+                ),
+                (b'host', b'localhost:8000')]
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'presence'
+        assert response['online'] == [{'id': user.pk, 'name': user.username}]
+        assert response['typing'] == []
+        # a burst of signals is sent to the room once
+        for i in range(10):
+            await communicator.send_json_to({
+                'message_type': 'typing',
+                'sender': {'id': user.pk, 'name': user.username},
+                'room_id': str(room.id),
+            })
+        response = await communicator.receive_json_from()
+        assert response['typing'] == [{'id': user.pk, 'name': user.username}]
+        # and expires
+        response = await communicator.receive_json_from(timeout=2)
+        assert response['typing'] == []
+        assert await communicator.receive_nothing()
+        await communicator.disconnect()
+    finally:
+        del settings.CHATTER_PRESENCE
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_presence_snapshot():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_PRESENCE = {'enabled': True, 'interval': 0.1}
+    client, room, user = prepare_room_and_user()
+    user1 = get_user_model().objects.get(username="user1")
+    room.members.add(user1)
+    other_client = Client()
+    other_client.force_login(user=user1)
+    try:
+        communicators = []
+        for session_client in (client, other_client):
+            communicator = WebsocketCommunicator(
+                application, f"/ws/django_chatter/chatrooms/{room.id}/",
+                headers=[
+                    (
+                        b'cookie',
+                        f'sessionid={session_client.cookies["sessionid"].value}'.encode('ascii')
+                    ),
+                    (b'host', b'localhost:8000')]
+            )
+            connected, subprotocol = await communicator.connect()
+            assert connected
+            communicators.append(communicator)
+        communicator, user1_communicator = communicators
+        both = [{'id': user.pk, 'name': user.username},
+                {'id': user1.pk, 'name': user1.username}]
+        # the second connection reads the first one from the snapshot
+        response = await user1_communicator.receive_json_from()
+        assert response['online'] == both
+        # and the first one hears of the second one from its join
+        response = await communicator.receive_json_from()
+        assert response['online'] == both[:1]
+        response = await communicator.receive_json_from()
+        assert response['online'] == both
+        await user1_communicator.disconnect()
+        response = await communicator.receive_json_from()
+        assert response['online'] == both[:1]
+        await communicator.disconnect()
+    finally:
+        del settings.CHATTER_PRESENCE
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_multiplex_consumer():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    client, room, user = prepare_room_and_user()
+    user1 = get_user_model().objects.get(username="user1")
+    other_client = Client()
+    other_client.force_login(user=user1)
+    room_with_two = Room.objects.create()
+    room_with_two.members.add(*[user, user1])
+    room_with_user_1 = Room.objects.create()
+    room_with_user_1.members.add(user1)
+
+    communicators = []
+    for session_client in (client, other_client):
+        communicator = WebsocketCommunicator(
+            application, "/ws/django_chatter/multiplex/",
+            headers=[
+                (
+                    b'cookie',
+                    f'sessionid={session_client.cookies["sessionid"].value}'.encode('ascii')
+                ),
+                (b'host', b'localhost:8000')]
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        communicators.append(communicator)
+    communicator, user1_communicator = communicators
+
+    await communicator.send_json_to({'type': 'subscribe', 'room_id': str(room_with_user_1.id)})
+    response = await communicator.receive_json_from()
+    assert response['type'] == 'error'
+    await communicator.send_json_to({'type': 'subscribe', 'room_id': str(room_with_two.id)})
+    response = await communicator.receive_json_from()
+    assert response == {'type': 'subscribed', 'room_id': str(room_with_two.id)}
+
+    await communicator.send_json_to({
+        'message_type': 'text',
+        'message': "Hello!",
+        'room_id': str(room_with_two.id),
+    })
+    response = await communicator.receive_json_from()
+    assert response['message'] == "Hello!"
+    # user1 isn't subscribed to the room: it gets the alert
+    alert = await user1_communicator.receive_json_from()
+    assert alert['message'] == "Hello!"
+    assert alert['room_id'] == str(room_with_two.id)
+
+    await communicator.send_json_to({'type': 'unsubscribe', 'room_id': str(room_with_two.id)})
+    response = await communicator.receive_json_from()
+    assert response == {'type': 'unsubscribed', 'room_id': str(room_with_two.id)}
+    await communicator.disconnect()
+    await user1_communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_large_room():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_LARGE_ROOM = {'threshold': 1, 'interval': 60}
+    client, room, user = prepare_room_and_user()
+    user1 = get_user_model().objects.get(username="user1")
+    room.members.add(user1)
+    other_client = Client()
+    other_client.force_login(user=user1)
+    try:
+        chat_communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/",
+            headers=[
+                (
+                    b'cookie',
+                    f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+                ),
+                (b'host', b'localhost:8000')]
+        )
+        connected, subprotocol = await chat_communicator.connect()
+        assert connected
+        user1_alert_communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/users/{user1.pk}/",
+            headers=[
+                (
+                    b'cookie',
+                    f'sessionid={other_client.cookies["sessionid"].value}'.encode('ascii')
+                ),
+                (b'host', b'localhost:8000')]
+        )
+        connected, subprotocol = await user1_alert_communicator.connect()
+        assert connected
+        for text in ("Hello!", "How are you?"):
+            await chat_communicator.send_json_to({
+                'message_type': 'text',
+                'message': text,
+                'sender': {'id': user.pk, 'name': user.username},
+                'room_id': str(room.id),
+            })
+            response = await chat_communicator.receive_json_from()
+            assert response['message'] == text
+        # a single alert without the messages
+        alert = await user1_alert_communicator.receive_json_from()
+        assert alert['type'] == 'room_activity'
+        assert alert['room_id'] == str(room.id)
+        assert 'message' not in alert
+        assert await user1_alert_communicator.receive_nothing()
+        await chat_communicator.disconnect()
+        await user1_alert_communicator.disconnect()
+    finally:
+        del settings.CHATTER_LARGE_ROOM
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_rate_limit():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_RATE_LIMIT = {'backend': 'local', 'user': (0.1, 2), 'room': None}
+    client, room, user = prepare_room_and_user()
+    try:
+        communicator = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/",
+            headers=[
+                (
+                    b'cookie',
+                    f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+                ),
+                (b'host', b'localhost:8000')]
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        for text in ("Hello!", "How are you?"):
+            await communicator.send_json_to({
+                'message_type': 'text',
+                'message': text,
+                'sender': {'id': user.pk, 'name': user.username},
+                'room_id': str(room.id),
+            })
+            response = await communicator.receive_json_from()
+            assert response['message'] == text
+        # the bucket of the user is empty: nothing is stored nor sent
+        await communicator.send_json_to({
+            'message_type': 'text',
+            'message': "Anyone?",
+            'sender': {'id': user.pk, 'name': user.username},
+            'room_id': str(room.id),
+            'client_id': "a1b2c3",
+        })
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'throttled'
+        assert response['client_id'] == "a1b2c3"
+        assert response['limit'] == 'user'
+        assert 0 < response['retry_after'] <= 10
+        assert await database_sync_to_async(Message.objects.count)() == 2
+        await communicator.disconnect()
+    finally:
+        del settings.CHATTER_RATE_LIMIT
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_consumer_msgpack_subprotocol():
+    msgpack = pytest.importorskip('msgpack')
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    client, room, user = prepare_room_and_user()
+    communicator = WebsocketCommunicator(
+        application, f"/ws/django_chatter/chatrooms/{room.id}/",
+        headers=[
+            (
+                b'cookie',
+                f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+            ),
+            (b'host', b'localhost:8000')],
+        subprotocols=['chatter.msgpack', 'chatter.json']
+    )
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    assert subprotocol == 'chatter.msgpack'
+    await communicator.send_to(bytes_data=msgpack.packb({
+        'k': 'text',
+        'm': "Hello!",
+        's': {'i': user.pk, 'n': user.username},
+        'r': str(room.id),
+    }))
+    response = msgpack.unpackb(await communicator.receive_from(), raw=False)
+    assert response['m'] == "Hello!"
+    assert response['s'] == {'i': user.pk, 'n': user.username}
+    await communicator.disconnect()
+
+
+def prepare_write_buffer_rooms(rooms_total=1):
+    set_up_data()
+    users = list(get_user_model().objects.filter(username__in=["user0", "user1"]))
+    rooms = []
+    for i in range(rooms_total):
+        room = Room.objects.create()
+        room.members.add(*users)
+        rooms.append(room)
+    return rooms, users
+
+
+def get_stored_texts(room):
+    return list(room.message_set.order_by('seq').values_list('text', flat=True))
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_write_buffer_flush_size():
+    (room,), (user, _) = prepare_write_buffer_rooms()
+    buffer = MessageWriteBuffer(flush_size=3, flush_interval=10)
+    for i in range(4):
+        buffer.add(room, user, f"message {i}")
+    await asyncio.sleep(0.2)
+    # a full batch doesn't wait for the interval, the rest does
+    assert await database_sync_to_async(get_stored_texts)(room) == \
+        ["message 0", "message 1", "message 2"]
+    assert len(buffer.pending) == 1
+    await database_sync_to_async(buffer.drain)()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_write_buffer_flush_interval():
+    (room,), (user, _) = prepare_write_buffer_rooms()
+    buffer = MessageWriteBuffer(flush_size=100, flush_interval=0.05)
+    buffer.add(room, user, "Hello")
+    buffer.add(room, user, "Are you there?")
+    assert await database_sync_to_async(get_stored_texts)(room) == []
+    await asyncio.sleep(0.3)
+    assert not buffer.pending
+    assert await database_sync_to_async(get_stored_texts)(room) == ["Hello", "Are you there?"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_write_buffer_order():
+    rooms, users = prepare_write_buffer_rooms(rooms_total=2)
+    buffer = MessageWriteBuffer(flush_size=5, flush_interval=0.05)
+    for i in range(12):
+        buffer.add(rooms[i % 2], users[0 if i % 3 else 1], f"message {i}")
+    await asyncio.sleep(0.3)
+    assert not buffer.pending
+    for offset, room in enumerate(rooms):
+        texts = [f"message {i}" for i in range(offset, 12, 2)]
+        assert await database_sync_to_async(get_stored_texts)(room) == texts
+        seqs = await database_sync_to_async(list)(
+            room.message_set.order_by('id').values_list('seq', flat=True))
+        assert seqs == list(range(1, 7))
+        await database_sync_to_async(room.refresh_from_db)()
+        assert room.message_seq == 6
+        assert room.last_message_preview == texts[-1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_write_buffer_failed_batch():
+    (room,), (user, _) = prepare_write_buffer_rooms()
+    await database_sync_to_async(room.add_message)(user, "Hello", client_id="a1b2c3")
+    buffer = MessageWriteBuffer(flush_size=3, flush_interval=0.05)
+    buffer.add(room, user, "Are you there?")
+    # sent again: the batch fails and its messages are stored one by one
+    buffer.add(room, user, "Hello", client_id="a1b2c3")
+    buffer.add(room, user, "Hello?")
+    await asyncio.sleep(0.3)
+    assert not buffer.pending
+    assert await database_sync_to_async(get_stored_texts)(room) == \
+        ["Hello", "Are you there?", "Hello?"]
+    seqs = await database_sync_to_async(list)(
+        room.message_set.order_by('seq').values_list('seq', flat=True))
+    assert seqs == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_write_buffer_drain():
+    (room,), (user, _) = prepare_write_buffer_rooms()
+    buffer = MessageWriteBuffer(flush_size=2, flush_interval=0.05)
+    buffer.add(room, user, "Hello")
+    buffer.add(room, user, "Are you there?")
+    buffer.add(room, user, "Bye")
+    # on shutdown, nothing waits for the interval, and the full batch the
+    # background task may be storing meanwhile is stored first
+    await database_sync_to_async(buffer.drain)()
+    assert not buffer.pending
+    assert await database_sync_to_async(get_stored_texts)(room) == \
+        ["Hello", "Are you there?", "Bye"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_write_behind_client_id():
+    settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+    settings.CHATTER_WRITE_BEHIND = {'enabled': True}
+    try:
+        client, room, user = prepare_room_and_user()
+        headers = [
+            (
+                b'cookie',
+                f'sessionid={client.cookies["sessionid"].value}'.encode('ascii')
+            ),
+            (b'host', b'localhost:8000')]
+        data = {
+            'message_type': 'text',
+            'message': "Hello!",
+            'sender': {'id': user.pk, 'name': user.username},
+            'room_id': str(room.id),
+            'client_id': "d4e5f6",
+        }
+        first = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/",
+            headers=headers
+        )
+        connected, subprotocol = await first.connect()
+        assert connected
+        await first.send_json_to(data)
+        ack = await first.receive_json_from()
+        assert not ack['duplicate']
+        response = await first.receive_json_from()
+        assert response['message'] == "Hello!"
+
+        # sent again through another connection before it's stored:
+        # acknowledged, but neither sent nor stored twice
+        second = WebsocketCommunicator(
+            application, f"/ws/django_chatter/chatrooms/{room.id}/",
+            headers=headers
+        )
+        connected, subprotocol = await second.connect()
+        assert connected
+        await second.send_json_to(data)
+        duplicate_ack = await second.receive_json_from()
+        assert duplicate_ack['duplicate']
+        assert duplicate_ack['date_created'] == ack['date_created']
+        assert await first.receive_nothing()
+        assert await second.receive_nothing()
+        await database_sync_to_async(get_write_buffer().drain)()
+        assert await database_sync_to_async(Message.objects.count)() == 1
+        await first.disconnect()
+        await second.disconnect()
+    finally:
+        del settings.CHATTER_WRITE_BEHIND
@@ -1,10 +1,11 @@
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
 from django.db.models import Count
 from django.test import TestCase
 from uuid import UUID
 
-from django_chatter.models import Room, Message
+from django_chatter.models import Room, Message, RoomMembership
 
 
 class RoomTestCase(TestCase):
@@ -57,7 +58,156 @@ class MessageTestCase(TestCase):
         message = Message(room=room, sender=user, text="Notes to myself")
         message.save()
 
+    def test_room_last_message(self):
+        print('testing the denormalized last message of a room')
+        room = Room.objects.get()
+        first = Message.objects.get()
+        second = Message.objects.create(room=room, sender=first.sender, text="x" * 300)
+        room.set_last_message(second)
+        # an older message does not replace the latest one
+        room.set_last_message(first)
+        room = Room.objects.get()
+        self.assertEqual(room.last_message, second)
+        self.assertEqual(room.last_message_sender, first.sender)
+        self.assertEqual(len(room.last_message_preview), 200)
+        self.assertEqual(room.last_message_date, second.date_created)
+
     def test_message_title(self):
         print('testing message titles')
         self.assertEqual(str(Message.objects.all()[0]),
                          'Notes to myself sent by "user0" in Room "user0"')
+
+
+class RoomMembershipTestCase(TestCase):
+
+    def setUp(self):
+        self.user0 = get_user_model().objects.create(username="user0")
+        self.user1 = get_user_model().objects.create(username="user1")
+        self.room = Room.objects.create()
+        self.room.members.add(self.user0, self.user1)
+
+    def send(self, sender, text):
+        return self.room.add_message(sender, text)
+
+    def test_memberships_follow_members(self):
+        print('testing read cursors are created and removed with room members')
+        self.assertEqual(RoomMembership.objects.filter(room=self.room).count(), 2)
+        self.room.members.remove(self.user1)
+        self.assertFalse(RoomMembership.objects.filter(user=self.user1).exists())
+
+    def test_memberships_follow_groups(self):
+        print('testing effective members through groups')
+        user2 = get_user_model().objects.create(username="user2")
+        group = Group.objects.create(name="group")
+        group.user_set.add(self.user1)
+        self.room.members_groups.add(group)
+        self.assertFalse(self.room.is_member(user2))
+
+        user2.groups.add(group)
+        self.assertTrue(self.room.is_member(user2))
+        self.assertEqual(set(self.room.get_members_all(pks=True)),
+                         {self.user0.pk, self.user1.pk, user2.pk})
+
+        # still a member through the group
+        self.room.members.remove(self.user1)
+        self.assertTrue(self.room.is_member(self.user1))
+
+        user2.groups.clear()
+        self.assertFalse(self.room.is_member(user2))
+        self.room.members_groups.remove(group)
+        self.assertFalse(self.room.is_member(self.user1))
+        self.assertEqual(list(self.room.get_members_all(excluding={'pk': self.user0.pk})), [])
+
+    def test_memberships_follow_deleted_groups(self):
+        print('testing effective members when a group is deleted')
+        user2 = get_user_model().objects.create(username="user2")
+        group = Group.objects.create(name="group")
+        group.user_set.add(self.user1, user2)
+        self.room.members_groups.add(group)
+        self.assertTrue(self.room.is_member(user2))
+
+        group.delete()
+        self.assertFalse(self.room.is_member(user2))
+        # still a direct member
+        self.assertTrue(self.room.is_member(self.user1))
+
+    def test_unread_tracking(self):
+        print('testing unread state with read cursors')
+        self.assertFalse(self.room.has_unread(self.user0))
+        message = self.send(self.user0, "Hello")
+        self.send(self.user0, "Are you there?")
+        self.assertFalse(self.room.has_unread(self.user0))
+        self.assertTrue(self.room.has_unread(self.user1))
+        self.assertEqual(self.room.get_unread_count(self.user0), 0)
+        self.assertEqual(self.room.get_unread_count(self.user1), 2)
+        self.assertEqual(self.room.get_unread_count(self.user1, limit=1), 1)
+
+        self.room.mark_read(self.user1)
+        self.assertFalse(self.room.has_unread(self.user1))
+        membership = RoomMembership.objects.get(room=self.room, user=self.user1)
+        self.assertEqual(membership.get_unread_count(), 0)
+
+        # the cursor never moves backwards
+        self.room.mark_read(self.user1, message)
+        self.assertFalse(self.room.has_unread(self.user1))
+
+        # answering the room is reading it
+        self.send(self.user0, "Hello again")
+        self.send(self.user1, "Hi")
+        self.assertFalse(self.room.has_unread(self.user1))
+        self.assertEqual(self.room.get_unread_count(self.user1), 0)
+        self.assertEqual(self.room.get_unread_count(self.user0), 1)
+
+    def test_batch_of_messages(self):
+        print('testing read cursors after a batch of messages')
+        messages = [
+            Message(room=self.room, sender=self.user0, text="Hello"),
+            Message(room=self.room, sender=self.user1, text="Hi"),
+            Message(room=self.room, sender=self.user0, text="How are you?"),
+        ]
+        Room.add_messages(messages)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message, messages[-1])
+        self.assertFalse(self.room.has_unread(self.user0))
+        self.assertTrue(self.room.has_unread(self.user1))
+        self.assertEqual(self.room.get_unread_count(self.user0), 0)
+        self.assertEqual(self.room.get_unread_count(self.user1), 1)
+
+    def test_number_legacy_messages(self):
+        print('testing the backfill of the messages stored before the sequence numbers')
+        Message.objects.create(room=self.room, sender=self.user0, text="Hello")
+        last = Message.objects.create(room=self.room, sender=self.user1, text="Hi")
+        self.room.number_messages()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_seq, 2)
+        self.assertEqual(self.room.last_message, last)
+        self.assertEqual(self.room.last_message_preview, "Hi")
+        self.assertTrue(self.room.has_unread(self.user0))
+
+    def test_message_sequence(self):
+        print('testing the sequence numbers of the messages of a room')
+        legacy = Message.objects.create(room=self.room, sender=self.user0, text="Legacy")
+        self.assertIsNone(legacy.seq)
+        first = self.room.add_message(self.user0, "Hello")
+        messages = [
+            Message(room=self.room, sender=self.user1, text="Hi"),
+            Message(room=self.room, sender=self.user0, text="How are you?"),
+        ]
+        Room.add_messages(messages)
+        self.assertEqual([first.seq] + [message.seq for message in messages], [1, 2, 3])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_seq, 3)
+
+        # messages stored before are numbered first
+        self.room.number_messages()
+        self.assertEqual(
+            list(self.room.message_set.order_by('seq').values_list('text', flat=True)),
+            ["Legacy", "Hello", "Hi", "How are you?"]
+        )
+        self.assertEqual(Room.objects.get(pk=self.room.pk).message_seq, 4)
+        self.assertEqual(self.room.add_message(self.user1, "Fine").seq, 5)
+
+        # a room deleted meanwhile takes no message
+        Room.objects.filter(pk=self.room.pk).delete()
+        with self.assertRaises(Room.DoesNotExist):
+            self.room.add_message(self.user1, "Bye")
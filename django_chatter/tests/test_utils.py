@@ -1,14 +1,36 @@
+import asyncio
+
 import pytest
 from channels.testing import WebsocketCommunicator
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import User
-from django.test import TestCase, Client
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, Client, override_settings
+from io import StringIO
+from unittest import mock
 
 from chatter.routing import multitenant_application
 from django_chatter.models import Room
-from django_chatter.utils import create_room
+from django_chatter.cache import TTLCache
+from django_chatter.recent import (
+    LocalRecentMessages,
+    get_latest_messages,
+    get_recent_messages,
+    load_entry,
+    remember_message,
+)
+from django_chatter.ratelimit import LocalRateLimiter, take_token, throttle
+from django_chatter.sanitizers import get_cleaner, sanitize
+from django_chatter.utils import (
+    create_room,
+    get_hostname_tenant,
+    get_hostname_tenant_async,
+    get_tenant_user,
+    tenants_cache,
+)
 from functional_tests.data_setup_for_tests import set_up_data
+from tenants.models import Domain
 
 
 class saveRoomTestCase(TestCase):
@@ -39,6 +61,31 @@ class saveRoomTestCase(TestCase):
         new_room = create_room([user1, user2])
         self.assertEqual(new_room, room)
 
+    def test_room_fingerprint(self):
+        user1 = User.objects.get(username="user1")
+        user2 = User.objects.get(username="user2")
+        user3 = User.objects.get(username="user3")
+        room = create_room([user2, user1])
+        self.assertEqual(room.members_fingerprint,
+                         Room.get_members_fingerprint([user1.pk, user2.pk]))
+        self.assertEqual(create_room([user1, user2]), room)
+
+        # the room isn't a direct room between user1 and user2 anymore
+        room.members.add(user3)
+        room.refresh_from_db()
+        self.assertIsNone(room.members_fingerprint)
+        self.assertNotEqual(create_room([user1, user2]), room)
+
+    def test_creating_existing_legacy_room(self):
+        user1 = User.objects.get(username="user1")
+        user2 = User.objects.get(username="user2")
+        room = Room.objects.create()
+        room.members.add(user1, user2)
+        call_command('fingerprint_rooms', stdout=StringIO())
+        room.refresh_from_db()
+        self.assertIsNotNone(room.members_fingerprint)
+        self.assertEqual(create_room([user1, user2]), room)
+
 
 TEST_CHANNEL_LAYERS = {
     'default': {
@@ -80,3 +127,158 @@ async def test_no_session_id_in_headers():
     )
     with pytest.raises(KeyError):
         connected, subprotocol = await communicator.connect()
+
+
+class TTLCacheTestCase(SimpleTestCase):
+    def test_least_recently_used_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiration(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        with mock.patch('django_chatter.cache.time.monotonic', return_value=0):
+            cache.set('a', 1)
+        with mock.patch('django_chatter.cache.time.monotonic', return_value=61):
+            self.assertIsNone(cache.get('a'))
+
+
+class RecentMessagesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="user1", password="chatter12345")
+        self.room = Room.objects.create()
+        self.room.members.add(self.user)
+        for i in range(5):
+            self.room.add_message(self.user, f"Message {i}")
+
+    def test_least_recently_used_rooms_dropped(self):
+        entry = load_entry(self.room, None, None, 3)
+        self.assertEqual([message.safe_text for message in entry.messages],
+                         ["Message 4", "Message 3", "Message 2"])
+        self.assertFalse(entry.complete)
+        recent_messages = LocalRecentMessages(max_bytes=2 * entry.size)
+        recent_messages.set('a', entry)
+        recent_messages.set('b', entry)
+        recent_messages.get('a')
+        recent_messages.set('c', entry)
+        self.assertIsNone(recent_messages.get('b'))
+        self.assertIs(recent_messages.get('a'), entry)
+        self.assertEqual(recent_messages.size, 2 * entry.size)
+
+    @override_settings(CHATTER_RECENT_MESSAGES={'backend': 'local', 'size': 3})
+    def test_latest_messages(self):
+        get_recent_messages().clear()
+        self.assertEqual([message.safe_text for message in get_latest_messages(self.room, 2)],
+                         ["Message 4", "Message 3"])
+        # not enough messages cached
+        self.assertIsNone(get_latest_messages(self.room, 4))
+
+        message = self.room.add_message(self.user, "Message 5")
+        remember_message(self.room, message)
+        with self.assertNumQueries(0):
+            self.assertEqual([message.safe_text for message in get_latest_messages(self.room, 3)],
+                             ["Message 5", "Message 4", "Message 3"])
+
+        # messages stored by other processes are read on validation
+        self.room.add_message(self.user, "Message 6")
+        self.assertEqual(get_latest_messages(self.room, 1)[0].safe_text, "Message 6")
+
+
+class SanitizersTestCase(SimpleTestCase):
+    def test_default_pipeline(self):
+        self.assertEqual(sanitize("<b>Hi</b><script>evil();</script>", html=False),
+                         "<b>Hi</b>&lt;script&gt;evil();&lt;/script&gt;")
+        self.assertEqual(sanitize("<script>evil();</script>", html=True),
+                         "<script>evil();</script>")
+        self.assertIs(get_cleaner(), get_cleaner())
+
+    @override_settings(CHATTER_SANITIZERS=['django_chatter.sanitizers.clean_html'],
+                       CHATTER_BLEACH_CLEANER={'tags': ['b'], 'strip': True})
+    def test_configured_pipeline(self):
+        self.assertEqual(sanitize("<b>Hi</b><script>evil();</script>", html=True),
+                         "<b>Hi</b>evil();")
+
+
+class TokenBucketTestCase(SimpleTestCase):
+    def test_take_token(self):
+        # 1 token per second, 2 at once
+        state, wait = take_token(None, 1, 2, now=0)
+        self.assertEqual((state, wait), ((1, 0), 0))
+        state, wait = take_token(state, 1, 2, now=0)
+        self.assertEqual(wait, 0)
+        state, wait = take_token(state, 1, 2, now=0.5)
+        self.assertEqual(wait, 0.5)
+        state, wait = take_token(state, 1, 2, now=1)
+        self.assertEqual(wait, 0)
+        # never more than the burst
+        state, wait = take_token(state, 1, 2, now=100)
+        self.assertEqual(state, (1, 100))
+
+    @override_settings(CHATTER_RATE_LIMIT={'backend': 'local', 'user': (1, 2), 'room': (1, 1)})
+    def test_throttle_takes_both_tokens_or_none(self):
+        rate_limiter = LocalRateLimiter()
+        self.assertIsNone(throttle(rate_limiter, 1, 'room'))
+        # refused by the room: the user keeps its token for another room
+        self.assertEqual(throttle(rate_limiter, 1, 'room')[0], 'room')
+        self.assertIsNone(throttle(rate_limiter, 1, 'other room'))
+        self.assertEqual(throttle(rate_limiter, 1, 'another room')[0], 'user')
+        self.assertEqual(rate_limiter.get_throttled_counts(), {'user': 1, 'room': 1})
+
+
+@pytest.mark.django_db(transaction=True)
+def test_hostname_tenant_cache():
+    tenants_cache.clear()
+    set_up_data()
+    tenant, schema_name = get_hostname_tenant('localhost')
+    assert schema_name == 'public'
+    assert len(tenants_cache) == 1
+    domain = Domain.objects.get(domain='localhost')
+    domain.save()
+    assert len(tenants_cache) == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_hostname_tenant_concurrent_misses():
+    tenants_cache.clear()
+    set_up_data()
+    with mock.patch('django_chatter.utils.get_hostname_tenant',
+                    wraps=get_hostname_tenant) as lookup:
+        tenants = await asyncio.gather(*[get_hostname_tenant_async('localhost')
+                                         for i in range(5)])
+        # looked up once, off the event loop
+        assert lookup.call_count == 1
+        assert {schema_name for tenant, schema_name in tenants} == {'public'}
+        await get_hostname_tenant_async('localhost')
+        assert lookup.call_count == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_session_user_cache():
+    set_up_data()
+    user = get_user_model().objects.get(username="user0")
+    client = Client()
+    client.force_login(user=user)
+    scope = {
+        'session': {},
+        'cookies': {'sessionid': client.cookies["sessionid"].value},
+        'headers': [(b'host', b'localhost:8000')],
+    }
+    assert await get_tenant_user(scope) == user
+    with mock.patch('django_chatter.utils.Session.objects.get') as session_get:
+        assert await get_tenant_user(scope) == user
+        assert not session_get.called
+        # the user itself isn't cached
+        get_user_model().objects.filter(pk=user.pk).update(is_active=False)
+        assert not (await get_tenant_user(scope)).is_active
+
+    # a new password invalidates the cached session, even saved without signals
+    user.set_password("new password")
+    get_user_model().objects.filter(pk=user.pk).update(password=user.password)
+    assert isinstance(await get_tenant_user(scope), AnonymousUser)
@@ -1,10 +1,13 @@
 import json
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.urls import reverse, resolve
 from django_tenants.test.cases import TenantTestCase
 from django_tenants.test.client import TenantClient
 
-from django_chatter.models import Room, Message
+from django_chatter.models import ROOM_NAME_MEMBERS_LIMIT, Room, Message
 from django_chatter.views import IndexView, users_list
 
 
@@ -59,6 +62,58 @@ class TestIndexView(TenantTestCase):
         )
 
 
+class TestRoomsList(TenantTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = TenantClient(self.tenant)
+        self.user = get_user_model().objects.create(username="ted")
+        self.user.set_password('dummypassword')
+        self.user.save()
+        self.other_users = []
+        for i in range(12):
+            user = get_user_model().objects.create(username=f"user{i}")
+            self.other_users.append(user)
+        self.room = self.create_room(self.other_users[0])
+
+    def create_room(self, *users):
+        room = Room.objects.create()
+        room.members.add(self.user, *users)
+        room.add_message(users[0], "Hello!")
+        return room
+
+    def get_room_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/room/{self.room.id}/")
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_queries_do_not_depend_on_rooms(self):
+        self.client.login(username="ted", password="dummypassword")
+        response, num_queries = self.get_room_queries()
+        self.assertEqual(len(response.context['rooms_list']), 1)
+
+        for i in range(1, 10):
+            # direct and group rooms
+            self.create_room(*self.other_users[i:i + (i % 3) + 1])
+        response, more_rooms_num_queries = self.get_room_queries()
+        self.assertEqual(len(response.context['rooms_list']), 10)
+        self.assertEqual(len(response.context['rooms_with_unread']), 9)
+        self.assertEqual(more_rooms_num_queries, num_queries)
+
+    def test_large_room_title(self):
+        users = [get_user_model().objects.create(username=f"member{i}")
+                 for i in range(ROOM_NAME_MEMBERS_LIMIT + 5)]
+        large_room = self.create_room(*users)
+        self.client.login(username="ted", password="dummypassword")
+        response, num_queries = self.get_room_queries()
+        room = [room for room in response.context['rooms_list'] if room.pk == large_room.pk][0]
+        # only the members in the title are loaded
+        self.assertEqual(len(room.memberships.all()), ROOM_NAME_MEMBERS_LIMIT)
+        self.assertEqual(room.members_count, ROOM_NAME_MEMBERS_LIMIT + 6)
+        self.assertTrue(str(room).endswith("..."))
+
+
 class TestUsernames(TenantTestCase):
 
     def setUp(self):
@@ -77,14 +132,64 @@ class TestUsernames(TenantTestCase):
             reverse('django_chatter:users_list'),
             HTTP_X_REQUESTED_WITH='XMLHttpRequest'
         )
+        self.assertEqual(response.status_code, 200)
+        # without a search term the first page of users
+        self.assertEqual(len(response.json()['results']), 5)
+        response = self.client.get(
+            reverse('django_chatter:users_list'),
+            {'q': 'USER'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
         json_array = []
-        for user in get_user_model().objects.all():
+        for user in get_user_model().objects.order_by('username'):
             dict = {}
             dict["id"] = user.pk
             dict["text"] = user.username
             json_array.append(dict)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(str(response.content, encoding='utf-8'), json.dumps(json_array))
+        self.assertEqual(response.json(), {
+            'results': json_array,
+            'pagination': {'more': False}
+        })
+
+    def test_users_list_conditional_requests(self):
+        self.client.login(username="user0", password="dummypassword")
+        url = reverse('django_chatter:users_list')
+        response = self.client.get(url, {'q': 'user'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        etag = response['ETag']
+        response = self.client.get(url, {'q': 'user'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        get_user_model().objects.create(username="user5")
+        response = self.client.get(url, {'q': 'user'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 6)
+
+    @override_settings(CHATTER_USER_SEARCH_LIMIT=2)
+    def test_users_search_pagination(self):
+        self.client.login(username="user0", password="dummypassword")
+        url = reverse('django_chatter:users_list')
+        response = self.client.get(url, {'q': 'user', 'page': 3},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json(), {
+            'results': [{'id': get_user_model().objects.get(username='user4').pk,
+                         'text': 'user4'}],
+            'pagination': {'more': False}
+        })
+        response = self.client.get(url, {'q': 'user', 'page': 1},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([user['text'] for user in response.json()['results']],
+                         ['user0', 'user1'])
+        self.assertTrue(response.json()['pagination']['more'])
+        response = self.client.get(url, {'q': 'user3'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([user['text'] for user in response.json()['results']],
+                         ['user3'])
 
 
 class TestMessagesFetch(TenantTestCase):
@@ -107,6 +212,7 @@ class TestMessagesFetch(TenantTestCase):
         messages_array = []
         for message in messages:
             dict = {}
+            dict['id'] = message.pk
             dict['sender'] = message.sender.username
             dict['message'] = message.text
             dict['received_room_id'] = room_uuid
@@ -126,6 +232,7 @@ class TestMessagesFetch(TenantTestCase):
         messages_array = []
         for message in messages:
             dict = {}
+            dict['id'] = message.pk
             dict['sender'] = message.sender.username
             dict['message'] = message.text
             dict['received_room_id'] = room_uuid
@@ -148,3 +255,61 @@ class TestMessagesFetch(TenantTestCase):
         content = json.loads(response.content)
 
         self.assertEqual(content, [])
+
+    def test_conditional_requests(self):
+        self.client.login(username="ted", password="dummypassword")
+        room = Room.objects.get()
+        url = reverse('django_chatter:get_messages', args=[room.pk])
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        room.add_message(get_user_model().objects.get(username="ted"), "New message")
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+
+        # edits and deletions don't change the date of the room
+        message = room.message_set.get(text="New message")
+        message.text = "Edited message"
+        message.save()
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        message.delete()
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_keyset_pagination(self):
+        logged_in = self.client.login(username="ted", password="dummypassword")
+        assert logged_in
+        room_uuid = str(Room.objects.all()[0].id)
+        messages = list(Message.objects.order_by('-date_created', '-id'))
+
+        # the window displays the latest message, older ones are fetched from it
+        response = self.client.get(
+            f'/ajax/get-messages/{room_uuid}/?before={messages[0].pk}',
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        content = json.loads(response.content)
+        self.assertEqual([m['id'] for m in content['messages']],
+                         [m.pk for m in messages[1:21]])
+        self.assertEqual(content['next_before'], messages[20].pk)
+
+        response = self.client.get(
+            f'/ajax/get-messages/{room_uuid}/?before={content["next_before"]}',
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        content = json.loads(response.content)
+        self.assertEqual([m['id'] for m in content['messages']],
+                         [m.pk for m in messages[21:]])
+        self.assertIsNone(content['next_before'])
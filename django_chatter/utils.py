@@ -1,8 +1,12 @@
+import asyncio
 import traceback
+from contextlib import contextmanager
+from functools import partial
 
 from channels.auth import AuthMiddleware
 from channels.db import database_sync_to_async
 from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
 from django.contrib.auth import (
     get_user_model,
     HASH_SESSION_KEY,
@@ -10,14 +14,148 @@ from django.contrib.auth import (
 )
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sessions.models import Session
-from django.db.models import Count
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import IntegrityError, connection, transaction
 from django.http import Http404
+from django.utils import timezone
 from django.utils.crypto import constant_time_compare
 
+from django_chatter.cache import TTLCache
 from django_chatter.models import Room
 
 User = get_user_model()
 
+# hostname -> (tenant, schema name), cleared when a domain or tenant changes.
+tenants_cache = TTLCache(maxsize=getattr(settings, "CHATTER_TENANT_CACHE_SIZE", 1024),
+                         ttl=getattr(settings, "CHATTER_TENANT_CACHE_TTL", 300))
+
+
+def get_hostname_tenant(hostname):
+    """Returns the tenant of the hostname and its schema name"""
+    cached = tenants_cache.get(hostname)
+    if cached is None:
+        from django_tenants.utils import get_tenant_domain_model
+        domain_model = get_tenant_domain_model()
+        domain = domain_model.objects.select_related('tenant').get(domain=hostname)
+        try:
+            tenant = domain.tenant
+        except domain_model.DoesNotExist:
+            raise Http404('No tenant for hostname "%s"' % hostname)
+        cached = (tenant, tenant.schema_name)
+        tenants_cache.set(hostname, cached)
+    return cached
+
+
+# hostname -> running lookup of its tenant, shared by the connections that miss the cache
+_tenant_lookups = {}
+
+
+async def get_hostname_tenant_async(hostname):
+    """`get_hostname_tenant` without blocking the event loop: a cache miss is
+    looked up in a database thread, once for all the concurrent misses of the hostname"""
+    cached = tenants_cache.get(hostname)
+    if cached is not None:
+        return cached
+    lookup = _tenant_lookups.get(hostname)
+    if lookup is None:
+        lookup = asyncio.ensure_future(database_sync_to_async(get_hostname_tenant)(hostname))
+        _tenant_lookups[hostname] = lookup
+        lookup.add_done_callback(lambda future: _tenant_lookups.pop(hostname, None))
+    # a connection that goes away doesn't cancel the lookup of the others
+    return await asyncio.shield(lookup)
+
+
+def get_chatter_cache():
+    return caches[getattr(settings, "CHATTER_CACHE", DEFAULT_CACHE_ALIAS)]
+
+
+def get_session_cache_key(schema_name, session_key):
+    return f'chatter:session:{schema_name}:{session_key}'
+
+
+def is_session_hash_valid(user, session_hash):
+    """Checks the hash stored in a session against the current one of its user,
+    which changes with the password"""
+    if not hasattr(user, "get_session_auth_hash"):
+        return True
+    return bool(session_hash) and constant_time_compare(
+        session_hash, user.get_session_auth_hash()
+    )
+
+
+def cache_session_user(schema_name, session_key, uid, session_hash):
+    """Caches the user id and the hash of a verified session for
+    CHATTER_SESSION_CACHE_TTL seconds (60 by default, 0 disables it)"""
+    timeout = getattr(settings, "CHATTER_SESSION_CACHE_TTL", 60)
+    if not timeout:
+        return
+    get_chatter_cache().set(get_session_cache_key(schema_name, session_key),
+                            (uid, session_hash), timeout)
+
+
+def get_cached_session_user(schema_name, session_key):
+    """The user of a cached session, fetched again so that it's never stale.
+    None if the session isn't cached or its hash no longer matches the user
+    (e.g. a new password), whose entry is dropped."""
+    cache = get_chatter_cache()
+    cache_key = get_session_cache_key(schema_name, session_key)
+    cached = cache.get(cache_key)
+    if cached is None:
+        return None
+    uid, session_hash = cached
+    user = User.objects.filter(pk=uid).first()
+    if user is None or not is_session_hash_valid(user, session_hash):
+        cache.delete(cache_key)
+        return None
+    return user
+
+
+def forget_session_user(schema_name, session_key):
+    get_chatter_cache().delete(get_session_cache_key(schema_name, session_key))
+
+
+# the caches of a tenant are namespaced by its schema
+def get_schema_name():
+    return getattr(connection, 'schema_name', None)
+
+
+def get_users_version_cache_key(schema_name):
+    return f'chatter:users-version:{schema_name}'
+
+
+def get_room_version_cache_key(schema_name, room_pk):
+    return f'chatter:room-version:{schema_name}:{room_pk}'
+
+
+def get_version(cache_key):
+    """Date of the last change as far as the cache knows (the current date once
+    it's evicted), which validates what depends on it"""
+    cache = get_chatter_cache()
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, timezone.now(), None)
+        version = cache.get(cache_key, timezone.now())
+    return version
+
+
+def get_users_version(schema_name):
+    """Date of the last change of the users of the tenant. Validates the cached user lists."""
+    return get_version(get_users_version_cache_key(schema_name))
+
+
+def touch_users_version(schema_name):
+    get_chatter_cache().set(get_users_version_cache_key(schema_name), timezone.now(), None)
+
+
+def get_room_version(schema_name, room_pk):
+    """Date of the last edit or deletion of a message of the room, which new
+    messages don't change. Validates the history of the room."""
+    return get_version(get_room_version_cache_key(schema_name, room_pk))
+
+
+def touch_room_version(schema_name, room_pk):
+    get_chatter_cache().set(get_room_version_cache_key(schema_name, room_pk), timezone.now(), None)
+
 
 # custom get_user method for AuthMiddleware subclass. Mostly similar to
 # https://github.com/django/channels/blob/master/channels/auth.py
@@ -45,31 +183,26 @@ def get_tenant_user(scope):
     try:
         # get session and user using django-tenants' schema_context
         #  Link: https://django-tenants.readthedocs.io/en/latest/use.html#utils
-        from django_tenants.utils import get_tenant_domain_model
-        domain_model = get_tenant_domain_model()
-        domain = domain_model.objects.select_related('tenant').get(domain=hostname)
-        try:
-            tenant = domain.tenant
-        except domain_model.DoesNotExist:
-            raise Http404('No tenant for hostname "%s"' % hostname)
+        tenant, schema_name = get_hostname_tenant(hostname)
         from django.db import connection
         connection.set_tenant(tenant)
-        session = Session.objects.get(session_key=session_key)
-        uid = session.get_decoded().get(SESSION_KEY)
-        user = User.objects.get(pk=uid)
-
-        # Verifying the session
-        # collected from:
-        # https://github.com/django/channels/blob/master/channels/auth.py
-        # line 44 onwards
-        if hasattr(user, "get_session_auth_hash"):
-            session_hash = session.get_decoded().get(HASH_SESSION_KEY)
-            session_hash_verified = session_hash and constant_time_compare(
-                session_hash, user.get_session_auth_hash()
-            )
-            if not session_hash_verified:
-                session.flush()
+        user = get_cached_session_user(schema_name, session_key)
+        if user is None:
+            session = Session.objects.get(session_key=session_key)
+            session_data = session.get_decoded()
+            uid = session_data.get(SESSION_KEY)
+            user = User.objects.get(pk=uid)
+
+            # Verifying the session
+            # collected from:
+            # https://github.com/django/channels/blob/master/channels/auth.py
+            # line 44 onwards
+            session_hash = session_data.get(HASH_SESSION_KEY)
+            if is_session_hash_valid(user, session_hash):
+                cache_session_user(schema_name, session_key, uid, session_hash)
+            else:
                 user = None
+                session.delete()
     except Exception as e:
         print(traceback.format_exc())
         pass
@@ -97,25 +230,28 @@ class MTSchemaMiddleware:
         for key, value in scope.get('headers', []):
             if key == b'host':
                 hostname = value.decode('ascii').split(':')[0]
-                from django_tenants.utils import get_tenant_domain_model
-                domain_model = get_tenant_domain_model()
-                domain = domain_model.objects.select_related('tenant') \
-                    .get(domain=hostname)
-                try:
-                    tenant = domain.tenant
-                    schema_name = tenant.schema_name
-                except domain_model.DoesNotExist:
-                    raise Http404('No tenant for hostname "%s"' % hostname)
                 break
         else:
             raise ValueError(
                 "The headers key in the scope is invalid. "
                 + "(make sure it is passed valid HTTP or WebSocket connections)"
             )
+        cached = tenants_cache.get(hostname)
+        if cached is None:
+            # the inner application is built once the tenant is known
+            return partial(self.coroutine_call, scope, hostname)
+        tenant, schema_name = cached
         return self.inner(
             dict(scope, schema_name=schema_name, multitenant=True)
         )
 
+    async def coroutine_call(self, scope, hostname, receive, send):
+        tenant, schema_name = await get_hostname_tenant_async(hostname)
+        inner_instance = self.inner(
+            dict(scope, schema_name=schema_name, multitenant=True)
+        )
+        await inner_instance(receive, send)
+
 
 # MiddlewareStack to give access to user object in a multitenant environment
 ChatterMTMiddlewareStack = lambda inner: CookieMiddleware(
@@ -136,17 +272,33 @@ def create_room(user_list, **kwargs):
                             "you passed contains valid User objects as defined in your "
                             "settings.AUTH_USER_MODEL parameter.")
 
-    rooms = Room.objects.filter(members__in=user_list)
-
-    rooms = rooms.annotate(num_members=Count('members'))
-    rooms = rooms.filter(num_members=len(user_list))
-
-    room = rooms.first()
+    users_pks = [user.pk for user in user_list]
+    fingerprint = Room.get_members_fingerprint(users_pks)
+    room = Room.objects.filter(members_fingerprint=fingerprint).first()
 
     if not room:
-        room = Room(**kwargs)
-        room.save()
-        room.members.set(user_list)
-        room.save()
+        try:
+            with transaction.atomic():
+                room = Room(members_fingerprint=fingerprint, **kwargs)
+                room.save()
+                room.members.set(user_list)
+        except IntegrityError:
+            # the same room was created concurrently
+            room = Room.objects.get(members_fingerprint=fingerprint)
 
     return room
+
+
+@contextmanager
+def tenant_context(multitenant=False, schema_name=None):
+    """Runs the block inside the schema of the tenant on multitenant environments"""
+    if not multitenant:
+        yield
+        return
+    if not schema_name:
+        raise AttributeError("Multitenancy support error: \
+            scope does not have multitenancy details added. \
+            did you forget to add ChatterMTMiddlewareStack to your routing?")
+    from django_tenants.utils import schema_context
+    with schema_context(schema_name):
+        yield
@@ -5,21 +5,32 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponseRedirect, JsonResponse, Http404
+from django.db.models import Count, Exists, IntegerField, OuterRef, Prefetch, Q, Subquery
+from django.http import HttpResponseRedirect, JsonResponse, Http404, HttpResponseBadRequest
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext as _
 from django.views import View
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic.base import TemplateView
 
-from django_chatter.models import Room
-from django_chatter.utils import create_room
+from django_chatter.models import ROOM_NAME_MEMBERS_LIMIT, Room, RoomMembership
+from django_chatter.recent import get_latest_messages
+from django_chatter.utils import (
+    create_room,
+    get_room_version,
+    get_schema_name,
+    get_users_version,
+)
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+MESSAGES_PAGE_SIZE = 20
+
 
 def import_base_template():
     try:
@@ -82,10 +93,17 @@ class ChatRoomView(LoginRequiredMixin, TemplateView):
         user = self.request.user
         all_members = room.members.all()
         if all_members.filter(pk=user.pk).exists():
-            latest_messages_curr_room = room.message_set.all()[:50]
-            if latest_messages_curr_room.exists():
-                message = latest_messages_curr_room[0]
-                message.recipients.add(user)
+            latest_messages_curr_room = get_latest_messages(room, 50)
+            if latest_messages_curr_room is None:
+                latest_messages_curr_room = room.message_set.all()[:50]
+            if latest_messages_curr_room:
+                # the websocket resumes after the latest message displayed
+                context['last_message_id'] = latest_messages_curr_room[0].pk
+                context['last_seq'] = latest_messages_curr_room[0].seq
+                # cursor of the history fetched when scrolling up
+                context['messages_before'] = \
+                    latest_messages_curr_room[len(latest_messages_curr_room) - 1].pk
+            room.mark_read(user)
             if all_members.count() == 1:
                 room_name = _("Notes to Yourself")
             elif all_members.count() == 2:
@@ -98,18 +116,32 @@ class ChatRoomView(LoginRequiredMixin, TemplateView):
             context['base_template'] = import_base_template()
 
             # Add rooms with unread messages
+            # The read cursor of the user is compared with the last message of
+            # each room in the same query, so the number of queries doesn't
+            # depend on the number of rooms.
+            last_message_read = RoomMembership.objects.filter(
+                room=OuterRef('pk'),
+                user=user,
+                last_read_message__gte=OuterRef('last_message')
+            )
+            # Rooms are named after their members: only the first ones are
+            # loaded, however large the rooms are, and the others are counted.
+            members_count = RoomMembership.objects.filter(room=OuterRef('pk')).order_by() \
+                .values('room').annotate(count=Count('pk')).values('count')
+            first_memberships = RoomMembership.objects.filter(room=OuterRef('room')) \
+                .order_by('pk').values('pk')[:ROOM_NAME_MEMBERS_LIMIT]
+            memberships = RoomMembership.objects.filter(pk__in=Subquery(first_memberships)) \
+                .select_related('user').order_by('pk')
             rooms_list = Room.objects.filter(members__in=[user]) \
+                             .annotate(last_message_read=Exists(last_message_read),
+                                       members_count=Subquery(members_count,
+                                                              output_field=IntegerField())) \
+                             .select_related('last_message_sender') \
+                             .prefetch_related(Prefetch('memberships', queryset=memberships)) \
                              .order_by('-date_modified')[:10]
-            rooms_with_unread = []
-            # Go through each list of rooms and check if the last message was unread
-            # and add each last message to the context
-            for room in rooms_list:
-                try:
-                    message = room.message_set.all().order_by('-id')[0]
-                except IndexError as e:
-                    continue
-                if not message.recipients.filter(pk=user.pk).exists():
-                    rooms_with_unread.append(room.pk)
+            rooms_with_unread = [room.pk for room in rooms_list
+                                 if room.last_message_id and not room.last_message_read and
+                                 room.last_message_sender_id != user.pk]
             context['rooms_list'] = rooms_list
             context['rooms_with_unread'] = rooms_with_unread
 
@@ -118,18 +150,52 @@ class ChatRoomView(LoginRequiredMixin, TemplateView):
             raise Http404(_("Sorry! What you're looking for isn't here."))
 
 
+def search_users(term):
+    """Users whose username matches the term, by the CHATTER_USER_SEARCH_LOOKUP
+    lookup ('istartswith' by default)"""
+    username_field = User.USERNAME_FIELD
+    users = User.objects.order_by(username_field)
+    if term:
+        lookup = getattr(settings, "CHATTER_USER_SEARCH_LOOKUP", "istartswith")
+        users = users.filter(**{f'{username_field}__{lookup}': term})
+    return users
+
+
+def users_list_etag(request):
+    return get_users_version(get_schema_name()).isoformat()
+
+
+def users_list_last_modified(request):
+    return get_users_version(get_schema_name())
+
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=users_list_etag, last_modified_func=users_list_last_modified)
 def users_list(request):
-    """The following functions deal with AJAX requests"""
+    """The following functions deal with AJAX requests
+    Search of users for the Select2 picker: ?q=<term>&page=<number>
+    """
     if request.is_ajax():
+        page_size = getattr(settings, "CHATTER_USER_SEARCH_LIMIT", 20)
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        offset = (page - 1) * page_size
+        # one more to know if there's a next page without counting
+        users = list(search_users(request.GET.get('q', '').strip())[offset:offset + page_size + 1])
         data_array = []
-        for user in User.objects.all():
+        for user in users[:page_size]:
             data = {
                 'id': user.pk,
                 'text': str(user)
             }
             data_array.append(data)
-        return JsonResponse(data_array, safe=False)
+        return JsonResponse({
+            'results': data_array,
+            'pagination': {'more': len(users) > page_size}
+        })
 
 
 class ChatUrlView(View):
@@ -164,37 +230,96 @@ class ChatUrlView(View):
         return reverse('django_chatter:chatroom', args=[room.pk])
 
 
+def serialize_message(message, room_uuid):
+    return {
+        'id': message.pk,
+        'sender': {
+            'name': str(message.sender),
+            'id': message.sender.pk
+        },
+        'message': message.safe_text,
+        'received_room_id': room_uuid,
+        'date_created': message.date_created.strftime("%d %b %Y %H:%M:%S %Z")
+    }
+
+
+def get_messages_before(room, before, page_size):
+    """Keyset pagination: returns the messages older than the message `before`
+    and the cursor of the next page (None on the last page)"""
+    messages_qs = room.message_set.select_related('sender') \
+        .order_by('-date_created', '-id')
+    anchor = room.message_set.filter(pk=before).values_list('date_created', flat=True).first()
+    if anchor is None:
+        return [], None
+    messages_qs = messages_qs.filter(
+        Q(date_created__lt=anchor) |
+        Q(date_created=anchor, pk__lt=before)
+    )
+    selected = list(messages_qs[:page_size + 1])
+    next_before = None
+    if len(selected) > page_size:
+        selected = selected[:page_size]
+        next_before = selected[-1].pk
+    return selected, next_before
+
+
+def messages_etag(request, uuid):
+    """Validates the history of the room, None if the user isn't a member.
+    New messages change the date of the room, edits and deletions its version,
+    and the history also shows the names of the senders."""
+    date_modified = Room.objects.filter(
+        pk=uuid, members=request.user
+    ).values_list('date_modified', flat=True).first()
+    if date_modified is not None:
+        schema_name = get_schema_name()
+        room_version = get_room_version(schema_name, uuid)
+        users_version = get_users_version(schema_name)
+        return f'{date_modified.isoformat()}-{room_version.isoformat()}-{users_version.isoformat()}'
+
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=messages_etag)
 def get_messages(request, uuid):
-    """Ajax request to fetch earlier messages"""
+    """Ajax request to fetch earlier messages
+    ?before=<message id> uses the keyset pagination, ?page=N the page number
+    """
     if request.is_ajax():
         user = request.user
         room = Room.objects.get(pk=uuid)
         if room.members.filter(pk=user.pk).exists():
-            messages_qs = room.message_set.all()
+            before = request.GET.get('before')
+            if before is not None:
+                try:
+                    before = int(before)
+                except ValueError:
+                    return HttpResponseBadRequest()
+                selected, next_before = get_messages_before(room, before, MESSAGES_PAGE_SIZE)
+                return JsonResponse({
+                    'messages': [serialize_message(message, uuid) for message in selected],
+                    'next_before': next_before
+                })
             page = request.GET.get('page')
-            paginator = Paginator(messages_qs, 20)
             try:
-                selected = paginator.page(page)
-            except PageNotAnInteger:
-                selected = paginator.page(1)
-            except EmptyPage:
-                selected = []
+                first_page = int(page) == 1
+            except (TypeError, ValueError):
+                first_page = True
+            selected = get_latest_messages(room, MESSAGES_PAGE_SIZE) if first_page else None
+            if selected is None:
+                messages_qs = room.message_set.select_related('sender')
+                paginator = Paginator(messages_qs, MESSAGES_PAGE_SIZE)
+                try:
+                    selected = paginator.page(page)
+                except PageNotAnInteger:
+                    selected = paginator.page(1)
+                except EmptyPage:
+                    selected = []
             messages = []
             for message in selected:
-                data = {
-                    'sender': {
-                        'name': str(message.sender),
-                        'id': message.sender.pk
-                    },
-                    'message': message.text,
-                    'received_room_id': uuid,
-                    'date_created': message.date_created.strftime("%d %b %Y %H:%M:%S %Z")
-                }
-                messages.append(data)
+                messages.append(serialize_message(message, uuid))
             return JsonResponse(messages, safe=False)
 
         else:
-            return Http404(_("Sorry! We can't find what you're looking for."))
+            raise Http404(_("Sorry! We can't find what you're looking for."))
     else:
-        return Http404(_("Sorry! We can't find what you're looking for."))
+        raise Http404(_("Sorry! We can't find what you're looking for."))
@@ -0,0 +1,125 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# websocket subprotocols a client can ask for (Sec-WebSocket-Protocol).
+# Without one, frames are JSON text with the full keys.
+JSON_SUBPROTOCOL = 'chatter.json'
+MSGPACK_SUBPROTOCOL = 'chatter.msgpack'
+
+# keys of the events as sent in MessagePack frames
+SHORT_KEYS = {
+    'type': 't',
+    'message_type': 'k',
+    'id': 'i',
+    'seq': 'q',
+    'message': 'm',
+    'date_created': 'd',
+    'sender': 's',
+    'name': 'n',
+    'room_id': 'r',
+    'client_id': 'c',
+    'duplicate': 'x',
+    'messages': 'ms',
+    'more': 'mo',
+    'html': 'h',
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+
+def json_dumps(content):
+    """Encodes to JSON with the fastest encoder installed (orjson, ujson or json)"""
+    if orjson is not None:
+        return orjson.dumps(content).decode()
+    if ujson is not None:
+        return ujson.dumps(content, ensure_ascii=False, escape_forward_slashes=False)
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':'))
+
+
+def json_loads(text_data):
+    if orjson is not None:
+        return orjson.loads(text_data)
+    if ujson is not None:
+        return ujson.loads(text_data)
+    return json.loads(text_data)
+
+
+def rename_keys(content, keys):
+    if isinstance(content, dict):
+        return {keys.get(key, key): (rename_keys(value, keys)
+                                     if isinstance(value, (dict, list)) else value)
+                for key, value in content.items()}
+    if isinstance(content, list):
+        return [rename_keys(value, keys) if isinstance(value, (dict, list)) else value
+                for value in content]
+    return content
+
+
+def msgpack_dumps(content):
+    return msgpack.packb(rename_keys(content, SHORT_KEYS), use_bin_type=True)
+
+
+def msgpack_loads(bytes_data):
+    return rename_keys(msgpack.unpackb(bytes_data, raw=False), LONG_KEYS)
+
+
+def get_subprotocols():
+    """The subprotocols the server can speak, in order of preference"""
+    if msgpack is not None:
+        return [MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL]
+    return [JSON_SUBPROTOCOL]
+
+
+class WireFormatMixin:
+    """Mixin for AsyncJsonWebsocketConsumer: frames are MessagePack (binary,
+    with the SHORT_KEYS) when the client asks for the 'chatter.msgpack'
+    subprotocol and msgpack is installed, JSON otherwise. JSON is encoded with
+    orjson or ujson when they are installed.
+    """
+    subprotocol = None
+
+    def select_subprotocol(self):
+        requested = self.scope.get('subprotocols') or []
+        for subprotocol in get_subprotocols():
+            if subprotocol in requested:
+                return subprotocol
+        return None
+
+    async def accept(self, subprotocol=None):
+        if subprotocol is None:
+            subprotocol = self.select_subprotocol()
+        self.subprotocol = subprotocol
+        await super().accept(subprotocol)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.subprotocol == MSGPACK_SUBPROTOCOL:
+            await self.receive_json(msgpack_loads(bytes_data), **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def send_json(self, content, close=False):
+        if self.subprotocol == MSGPACK_SUBPROTOCOL:
+            await self.send(bytes_data=msgpack_dumps(content), close=close)
+        else:
+            await super().send_json(content, close=close)
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return json_loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return json_dumps(content)
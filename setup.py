@@ -37,5 +37,10 @@ setup(
         'channels==2.3.1',
         'channels-redis==2.4.2',
         'bleach==3.1.0',
-    ]
+    ],
+    extras_require={
+        # MessagePack websocket frames and a faster JSON encoder
+        'msgpack': ['msgpack>=0.6.1'],
+        'orjson': ['orjson'],
+    }
 )